@@ -1,7 +1,236 @@
 import comfy.utils  # type: ignore
+import comfy.model_management  # type: ignore
 import torch  # type: ignore
-from comfy_extras.nodes_upscale_model import ImageUpscaleWithModel  # type: ignore
 import math
+import hashlib
+import weakref
+import contextlib
+import logging
+import time
+import json
+import threading
+import psutil  # type: ignore
+from ComfyUI_GOAT_Nodes.nodes.image_tiler import plan_tiles, extract_tiles, get_tile_positions, allocate_mapped_buffer, Tile_Accumulator # type: ignore
+from ComfyUI_GOAT_Nodes.nodes.result_cache import Result_Cache, get_cache_key, hash_tensor # type: ignore
+from ComfyUI_GOAT_Nodes.nodes.devices import DTYPES # type: ignore
+from ComfyUI_GOAT_Nodes.nodes.resampling import get_mixed_initial, resample_rows # type: ignore
+
+
+def get_upscale_candidates(width, height, upscale_by, model_scale):
+    # Every pass sequence the node can run, as a list of (operation, input size, output size) steps
+    target = (round(width * upscale_by), round(height * upscale_by))
+    stage1 = [("model", (width, height), (width * model_scale, height * model_scale))]
+
+    def resize_to(steps, size):
+        current = steps[-1][2]
+        return steps + [("resize", current, size)] if current != size else steps
+
+    if model_scale == 1:
+        return {"quick": resize_to(stage1, target)}
+    if model_scale >= upscale_by:
+        return {"single_pass": resize_to(stage1, target)}
+
+    stage1_size = stage1[-1][2]
+    upscale_first = stage1 + [("model", stage1_size, (stage1_size[0] * model_scale, stage1_size[1] * model_scale))]
+    interim = (round(width * upscale_by / model_scale), round(height * upscale_by / model_scale))
+    downscale_first = resize_to(stage1, interim) + [("model", interim, (interim[0] * model_scale, interim[1] * model_scale))]
+
+    return {
+        "upscale_first": resize_to(upscale_first, target),
+        "downscale_first": resize_to(downscale_first, target),
+    }
+
+
+def estimate_upscale_cost(steps, channels=3, model_scale=1):
+    # Model cost in megapixels pushed through the model, and peak memory of the input and output tensors of a step, per image
+    model_megapixels = sum(size_in[0] * size_in[1] for operation, size_in, _ in steps if operation == "model") / 1e6
+    peak_bytes = max((size_in[0] * size_in[1] + size_out[0] * size_out[1]) for _, size_in, size_out in steps) * channels * 4
+
+    # A plan meets the target when its last model pass is at least as large as the output, so no detail gets made up by resizing
+    # Model outputs come in steps of model_scale pixels, so falling short by less than one step is only rounding
+    last_model_output = [size_out for operation, _, size_out in steps if operation == "model"][-1]
+    target = steps[-1][2]
+    meets_target = all(output > length - model_scale for output, length in zip(last_model_output, target))
+    return model_megapixels, peak_bytes, meets_target
+
+
+def plan_upscale(width, height, upscale_by, model_scale, stage2_order="auto", channels=3):
+    candidates = get_upscale_candidates(width, height, upscale_by, model_scale)
+    costs = {name: estimate_upscale_cost(steps, channels, model_scale) for name, steps in candidates.items()}
+
+    if stage2_order in candidates:
+        chosen = stage2_order
+    else:
+        # Cheapest plan that meets the target, or the cheapest plan if none does
+        meeting = [name for name in candidates if costs[name][2]] or list(candidates)
+        chosen = min(meeting, key=lambda name: costs[name][0])
+
+    model_megapixels, peak_bytes, _ = costs[chosen]
+    steps = " | ".join(f"{operation} {size_in[0]}x{size_in[1]} -> {size_out[0]}x{size_out[1]}" for operation, size_in, size_out in candidates[chosen])
+    alternatives = ", ".join(f"{name} {costs[name][0]:.2f} MP" for name in candidates if name != chosen)
+
+    description = f"{chosen}: {steps} | Model cost per image: {model_megapixels:.2f} MP | Peak memory per image: {peak_bytes / 1024 ** 3:.2f} GB"
+    if alternatives:
+        description += f" | Alternatives: {alternatives}"
+    return chosen, description, peak_bytes
+
+
+def get_inference_dtype(dtype_name, device):
+    # Falls back to float32 where the device has no autocast support for the precision
+    dtype = DTYPES[dtype_name]
+    supported = (
+        dtype == torch.float32
+        or (device.type == "cuda" and (dtype == torch.float16 or torch.cuda.is_bf16_supported()))
+        or (device.type == "cpu" and dtype == torch.bfloat16)
+    )
+    if not supported:
+        print(f"🐐 Advanced Upscale: {dtype_name} is not supported on {device.type}, using float32.")
+        return torch.float32
+    return dtype
+
+
+@contextlib.contextmanager
+def inference_settings(upscale_model, dtype_name="float32", channels_last=False):
+    # Model passes run under autocast, so inputs, outputs and weights stay float32 and every pass (plain, tiled or
+    # streamed) gets the same precision; channels_last converts the weights for the duration of the run
+    # Yields the precision actually used, which is float32 when the requested one is not supported on the device
+    device = comfy.model_management.get_torch_device()
+    dtype = get_inference_dtype(dtype_name, device)
+    if channels_last:
+        upscale_model.model.to(memory_format=torch.channels_last)
+    try:
+        if dtype == torch.float32:
+            yield dtype
+        else:
+            with torch.autocast(device.type, dtype=dtype):
+                yield dtype
+    finally:
+        if channels_last:
+            upscale_model.model.to(memory_format=torch.contiguous_format)
+
+
+def get_psnr(image, reference):
+    # Peak signal to noise ratio in dB for images in the 0 to 1 range
+    mse = torch.mean((image.float() - reference.float()) ** 2).item()
+    return math.inf if mse == 0 else 10 * math.log10(1 / mse)
+
+
+MODEL_FINGERPRINTS = weakref.WeakKeyDictionary()
+
+
+def get_model_fingerprint(upscale_model):
+    # Hashing the weights is expensive, so it is done once per loaded model object
+    try:
+        return MODEL_FINGERPRINTS[upscale_model]
+    except (KeyError, TypeError):
+        pass
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{type(upscale_model.model).__name__}|{upscale_model.scale}".encode())
+    for name, tensor in upscale_model.model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(hash_tensor(tensor).encode())
+    fingerprint = digest.hexdigest()
+
+    try:
+        MODEL_FINGERPRINTS[upscale_model] = fingerprint
+    except TypeError:
+        pass
+    return fingerprint
+
+
+RESULT_CACHE = Result_Cache(prefix="goat_upscale", name="Advanced Upscale")
+
+
+class Report_Progress_Bar:
+    # Takes the place of the comfy.utils.ProgressBar that comfy.utils.tiled_scale advances and forwards its progress to a
+    # report callback, so passes through ComfyUI's tiling move the bar of the node instead of replacing it
+    def __init__(self, total, report=None):
+        self.total = max(total, 1)
+        self.current = 0
+        self.report = report
+
+    def update_absolute(self, value, total=None, preview=None):
+        if total is not None:
+            self.total = max(total, 1)
+        self.current = min(value, self.total)
+        if self.report is not None:
+            self.report(self.current / self.total)
+
+    def update(self, value):
+        self.update_absolute(self.current + value)
+
+
+class RSS_Sampler:
+    # Samples the resident set size of the process on a background thread while it is entered, the CPU counterpart of
+    # the CUDA peak memory statistics
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = self.process.memory_info().rss
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+class Stage_Monitor:
+    # Owns the single progress bar of the node, checks for interruption before each stage and logs one structured record per stage
+    # Every stage spans STAGE_STEPS steps of the bar, so tile progress within a stage moves the same bar forward
+    logger = logging.getLogger(__name__)
+    STAGE_STEPS = 1000
+
+    def __init__(self, total_stages=None):
+        # Without total_stages the monitor only logs, for extra runs that must not touch the progress of the node
+        self.total = max(total_stages, 1) * self.STAGE_STEPS if total_stages is not None else None
+        self.progress = comfy.utils.ProgressBar(self.total) if self.total is not None else None
+        self.device = comfy.model_management.get_torch_device()
+        self.records = []
+        self.done_stages = 0
+
+
+    def report(self, fraction):
+        # Progress within the running stage, from 0 to 1
+        if self.progress is not None:
+            self.progress.update_absolute(min(round((self.done_stages + fraction) * self.STAGE_STEPS), self.total), self.total)
+
+
+    @contextlib.contextmanager
+    def stage(self, name, **details):
+        comfy.model_management.throw_exception_if_processing_interrupted()
+        is_cuda = self.device.type == "cuda"
+        if is_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        start = time.perf_counter()
+        with RSS_Sampler() as sampler:
+            yield
+        # Peak of the tensors allocated on the GPU, on the CPU the peak resident size of the process
+        peak_bytes = torch.cuda.max_memory_allocated(self.device) if is_cuda else sampler.peak
+        self.log(name, seconds=round(time.perf_counter() - start, 4), peak_memory_mb=round(peak_bytes / 1024 ** 2, 1), **details)
+
+
+    def skip(self, name, stages=1, **details):
+        # Stages served from the cache still count towards the progress
+        self.log(name, stages, cached=True, **details)
+
+
+    def log(self, name, stages=1, **details):
+        record = {"stage": name, **details, "rss_mb": round(psutil.Process().memory_info().rss / 1024 ** 2, 1)}
+        self.records.append(record)
+        self.logger.info("🐐 Advanced Upscale: %s", json.dumps(record), extra={"goat_upscale": record})
+        self.done_stages += stages
+        self.report(0)
 
 
 class Advanced_Upscale_Image_Using_Model:
@@ -13,57 +242,244 @@ class Advanced_Upscale_Image_Using_Model:
                 "image": ("IMAGE",),
                 "upscale_by": ("FLOAT", {"default": 2.0, "min": 1.0, "max": 16.0, "step": 0.025}),
                 "rescale_method": (["nearest-exact", "bilinear", "area", "bicubic", "lanczos"], {"default": "lanczos"}),
-                "stage2_order": (["upscale_first", "downscale_first"], {"default": "downscale_first"}),
+                "stage2_order": (["upscale_first", "downscale_first", "auto"], {"default": "downscale_first"}),
                 "mixed_initial": ("BOOLEAN", {"default": True}),
                 "tiled_upscale": ("BOOLEAN", {"default": False}),
+                "tile_size": ("INT", {"default": 512, "min": 64, "max": 8192, "step": 8}),
+                "tile_overlap": ("INT", {"default": 32, "min": 1, "max": 1024}),
+                "tile_batch_size": ("INT", {"default": 4, "min": 1, "max": 64}),
+                "batch_chunk_size": ("INT", {"default": 0, "min": 0, "max": 4096}),
+                "cache_results": ("BOOLEAN", {"default": False}),
+                "cache_budget_mb": ("INT", {"default": 2048, "min": 1, "max": 1048576}),
+                "cache_dir": ("STRING", {"default": ""}),
+                "fast_mixed_initial": ("BOOLEAN", {"default": False}),
+                "stream_stage2": ("BOOLEAN", {"default": False}),
+                "stream_band_height": ("INT", {"default": 512, "min": 16, "max": 8192, "step": 8}),
+                "stream_temp_dir": ("STRING", {"default": ""}),
+                "inference_dtype": (["float32", "bfloat16", "float16"], {"default": "float32"}),
+                "channels_last": ("BOOLEAN", {"default": False}),
+                "accuracy_check": ("BOOLEAN", {"default": False}),
             }
         }
 
-    RETURN_TYPES = ("IMAGE", "INT", "INT",)
-    RETURN_NAMES = ("IMAGE", "WIDTH", "HEIGHT",)
+    RETURN_TYPES = ("IMAGE", "INT", "INT", "STRING",)
+    RETURN_NAMES = ("IMAGE", "WIDTH", "HEIGHT", "PLAN",)
     FUNCTION = "exec"
     CATEGORY = '🐐 GOAT Nodes/Image'
     DESCRIPTION = '''
     Upscales the image using an upscale model.\n
     ‣ upscale_by | Upscale factor for the final resolution of the output image.\n
     ‣ rescale_method | Rescale method for resizing the image in intermediary steps.\n
-    ‣ stage2_order | Decides the order of upscaling and resizing when using very high upscale_by. downscale_first is a lot faster, but with a bit less detail. upscale_first is a lot slower but with a bit more detail.\n
+    ‣ stage2_order | Decides the order of upscaling and resizing when using very high upscale_by. downscale_first is a lot faster, but with a bit less detail. upscale_first is a lot slower but with a bit more detail. auto picks the plan with the lowest estimated model cost that still reaches the final resolution with the model.\n
     ‣ mixed_initial | Mixes the initial image with an upscaled and downscaled version before upscaling for very slight sharpness improvement.\n
-    ‣ tiled_upscale | Upscales the image in 2x2 tiles, which might be helpful in certain use cases. (Not faster, but might be more stable at extreme resolutions.)
+    ‣ tiled_upscale | Upscales the image in a grid of tiles, which keeps the memory of each model pass bounded and can be faster by batching tiles.\n
+    ‣ tile_size | (tiled) Maximum width and height of the tiles.\n
+    ‣ tile_overlap | (tiled) Overlap between adjacent tiles, which gets blended to hide the seams.\n
+    ‣ tile_batch_size | (tiled) Amount of tiles that are upscaled together in a single model pass.\n
+    ‣ batch_chunk_size | Amount of images of the batch that go through all stages together. 0 picks the chunk size automatically from the available memory.\n
+    ‣ cache_results | Keeps final and stage 1 results of every image keyed by its content, the model and settings, so identical images are not upscaled again.\n
+    ‣ cache_budget_mb | Memory budget of the result cache. Least recently used results are evicted first.\n
+    ‣ cache_dir | (optional) Directory that evicted results spill to instead of being dropped. Gets the same budget.\n
+    ‣ fast_mixed_initial | Computes the mixed initial image with precomputed kernels at native resolution instead of materializing the 2x upscale. Exact for nearest-exact, area, bilinear and bicubic; lanczos skips the 8 bit rounding of the resize and differs by about 1/255 on average. Off by default, so existing workflows keep their output.\n
+    ‣ stream_stage2 | Runs stage 2 on overlapping horizontal bands of the stage 1 image and blends them into a memory-mapped output, so very large upscales need a fixed amount of RAM. The returned image is backed by a temporary file.\n
+    ‣ stream_band_height | (streamed) Height of the bands in stage 1 pixels. Bands overlap by tile_overlap.\n
+    ‣ stream_temp_dir | (streamed) Directory for the memory-mapped output. Empty uses the system temp directory.\n
+    ‣ inference_dtype | Precision of every model pass, applied through autocast. Falls back to float32 where the device does not support it (float16 needs CUDA, bfloat16 works on CUDA and CPU).\n
+    ‣ channels_last | Runs the model with channels_last weights, which is faster for many convolutional models on recent GPUs and CPUs.\n
+    ‣ accuracy_check | Also upscales the first chunk in float32 without channels_last and adds the PSNR and speedup of the chosen settings to PLAN.\n
+    ‣ PLAN | The chosen pass sequence with its intermediate resolutions, estimated model cost and peak memory.
     '''
 
 
+    AUTO_CHUNK_MEMORY_FRACTION = 0.5
+
+
     @classmethod
     def exec(self, upscale_model, image, upscale_by,
-                         rescale_method, stage2_order, mixed_initial, tiled_upscale):
+                         rescale_method, stage2_order, mixed_initial, tiled_upscale,
+                         tile_size=512, tile_overlap=32, tile_batch_size=4, batch_chunk_size=0,
+                         cache_results=False, cache_budget_mb=2048, cache_dir="", fast_mixed_initial=False,
+                         stream_stage2=False, stream_band_height=512, stream_temp_dir="",
+                         inference_dtype="float32", channels_last=False, accuracy_check=False):
+        tile_settings = (tile_size, tile_overlap, tile_batch_size)
+        stream_settings = (stream_band_height, stream_temp_dir.strip()) if stream_stage2 else None
+        plan = ""
         try:
-            if mixed_initial:
-                image = self.create_mixed_initial(image, rescale_method)
-                
-            if(upscale_model.scale == 1):
-                print(f"🐐 Advanced Upscale: 1x upscale model detected.\n🐐 Advanced Upscale: Initializing quick upscale. (No tiling)")
-                image = self.only_upscale(upscale_model, image, rescale_method, upscale_by)
-                return (image, image.shape[1], image.shape[2],)
-
-            # Process Stage 1 (always upscale first)
-            stage1_result = self.process_stage1(upscale_model, image, upscale_by, rescale_method, tiled_upscale)
-
-            # Check if Stage 2 is needed
-            current_scale = stage1_result[1]
-            if current_scale < upscale_by:
-                # Process Stage 2
-                final_image = self.process_stage2(upscale_model, stage1_result[0], upscale_by, current_scale, rescale_method, stage2_order == "upscale_first", tiled_upscale)
-            else:
-                final_image = stage1_result[0]
-
-            return (final_image, final_image.shape[1], final_image.shape[2],)
+            stage2_order, plan, image_bytes = plan_upscale(image.shape[2], image.shape[1], upscale_by, upscale_model.scale, stage2_order, image.shape[3])
+            batch_size = image.shape[0]
+            chunk_size = batch_chunk_size if batch_chunk_size > 0 else self.get_auto_chunk_size(image_bytes)
+            chunk_size = min(chunk_size, batch_size)
+            plan += f" | Chunks: {math.ceil(batch_size / chunk_size)} of up to {chunk_size} images"
+            if stream_settings is not None and stage2_order in ("upscale_first", "downscale_first"):
+                plan += f" | Stage 2: streamed in bands of {stream_band_height} rows"
+            print(f"🐐 Advanced Upscale: Plan {plan}")
+
+            monitor = Stage_Monitor(math.ceil(batch_size / chunk_size) * self.get_stage_count(stage2_order, mixed_initial))
+
+            cache = None
+            if cache_results:
+                cache = RESULT_CACHE
+                cache.configure(cache_budget_mb * 1024 ** 2, cache_dir.strip())
+                model_fingerprint = get_model_fingerprint(upscale_model)
+
+            # Stream the batch through all stages chunk by chunk, so memory does not grow with the amount of images
+            final_image = None
+            for start in range(0, batch_size, chunk_size):
+                chunk = image[start:start + chunk_size]
+                cache_keys = None
+                if cache is not None:
+                    # Keys are per image, so hits do not depend on how the batch is split into chunks
+                    stage1_keys = [
+                        get_cache_key("stage1", hash_tensor(frame), model_fingerprint, upscale_by, rescale_method, mixed_initial, fast_mixed_initial,
+                                      tiled_upscale, tile_settings, inference_dtype, channels_last)
+                        for frame in chunk
+                    ]
+                    cache_keys = (stage1_keys, [get_cache_key("final", key, stage2_order, stream_settings) for key in stage1_keys])
+
+                chunk_start = time.perf_counter()
+                with inference_settings(upscale_model, inference_dtype, channels_last) as resolved_dtype:
+                    upscaled = self.upscale_chunk(upscale_model, chunk, upscale_by, rescale_method, stage2_order,
+                                                  mixed_initial, tiled_upscale, tile_settings, cache, cache_keys, fast_mixed_initial, monitor,
+                                                  stream_settings)
+                chunk_seconds = time.perf_counter() - chunk_start
+
+                if accuracy_check and start == 0 and (resolved_dtype != torch.float32 or channels_last):
+                    plan += " | " + self.check_accuracy(upscale_model, chunk, upscaled, chunk_seconds, upscale_by, rescale_method, stage2_order,
+                                                        mixed_initial, tiled_upscale, tile_settings, fast_mixed_initial, stream_settings)
+                if stream_settings is not None and upscaled.shape[0] == batch_size:
+                    # A single streamed chunk already is the whole output, copying it would pull the memory-mapped result into RAM
+                    final_image = upscaled
+                else:
+                    if final_image is None:
+                        shape = (batch_size,) + tuple(upscaled.shape[1:])
+                        if stream_settings is not None:
+                            final_image = allocate_mapped_buffer(shape, upscaled.dtype, stream_settings[1])
+                        else:
+                            final_image = torch.empty(shape, dtype=upscaled.dtype, device=upscaled.device)
+                    final_image[start:start + upscaled.shape[0]] = upscaled
+
+                del upscaled
+                comfy.model_management.soft_empty_cache()
+
+            if cache is not None:
+                print(f"🐐 Advanced Upscale: {cache.describe()}")
+            return (final_image, final_image.shape[1], final_image.shape[2], plan,)
+        except comfy.model_management.InterruptProcessingException:
+            # Cancelling the queue must stop the run, not return the input image
+            raise
         except Exception as e:
             print(f"🐐 Advanced Upscale: Returning input image. Error in exec: {str(e)}")
-            return (image, image.shape[1], image.shape[2],)
+            return (image, image.shape[1], image.shape[2], plan,)
+
+
+    @classmethod
+    def check_accuracy(self, upscale_model, image, upscaled, seconds, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale,
+                       tile_settings, fast_mixed_initial, stream_settings):
+        # Runs the same chunk through the float32 path and compares it with the result of the chosen inference settings
+        start = time.perf_counter()
+        with inference_settings(upscale_model):
+            reference = self.upscale_stages(upscale_model, image, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale,
+                                            tile_settings, fast_mixed_initial=fast_mixed_initial, monitor=Stage_Monitor(), stream_settings=stream_settings)
+        reference_seconds = time.perf_counter() - start
+
+        result = f"PSNR vs float32: {get_psnr(upscaled, reference.to(upscaled.device)):.2f} dB | Speedup: {reference_seconds / max(seconds, 1e-9):.2f}x"
+        print(f"🐐 Advanced Upscale: Accuracy check {result}")
+        return result
+
+
+    @classmethod
+    def get_auto_chunk_size(self, image_bytes):
+        memory_budget = comfy.model_management.get_free_memory(torch.device("cpu")) * self.AUTO_CHUNK_MEMORY_FRACTION
+        return max(1, int(memory_budget // max(image_bytes, 1)))
 
 
     @staticmethod
-    def create_mixed_initial(image, method):
+    def get_stage_count(stage2_order, mixed_initial):
+        return int(mixed_initial) + (2 if stage2_order in ("upscale_first", "downscale_first") else 1)
+
+
+    @classmethod
+    def upscale_chunk(self, upscale_model, image, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale, tile_settings,
+                      cache=None, cache_keys=None, fast_mixed_initial=False, monitor=None, stream_settings=None):
+        device = image.device
+        if cache is None:
+            return self.upscale_stages(upscale_model, image, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale, tile_settings,
+                                       fast_mixed_initial=fast_mixed_initial, monitor=monitor, stream_settings=stream_settings).to(device)
+
+        # Only the images without a cached result go through the stages, cache_keys holds the stage 1 and final key of every image
+        stage1_keys, final_keys = cache_keys
+        cached = [cache.get(key) for key in final_keys]
+        missing = [index for index, item in enumerate(cached) if item is None]
+        if not missing:
+            monitor.skip("final", self.get_stage_count(stage2_order, mixed_initial), images=image.shape[0])
+            return torch.cat([item[0] for item in cached]).to(device)
+
+        subset = image if len(missing) == image.shape[0] else image[missing]
+        result = self.upscale_stages(upscale_model, subset, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale, tile_settings,
+                                     cache, [stage1_keys[index] for index in missing], fast_mixed_initial, monitor, stream_settings)
+        for position, index in enumerate(missing):
+            cache.put(final_keys[index], (result[position:position + 1],))
+        if len(missing) == image.shape[0]:
+            return result.to(device)
+
+        for position, index in enumerate(missing):
+            cached[index] = (result[position:position + 1],)
+        return torch.cat([item[0].to(device) for item in cached])
+
+
+    @classmethod
+    def upscale_stages(self, upscale_model, image, upscale_by, rescale_method, stage2_order, mixed_initial, tiled_upscale, tile_settings,
+                       cache=None, stage1_keys=None, fast_mixed_initial=False, monitor=None, stream_settings=None):
+        monitor = monitor or Stage_Monitor()
+        images = image.shape[0]
+        if(upscale_model.scale == 1):
+            if mixed_initial:
+                with monitor.stage("mixed_initial", images=images):
+                    image = self.create_mixed_initial(image, rescale_method, fast_mixed_initial)
+            # 1x upscale model, quick upscale without tiling
+            with monitor.stage("quick", images=images):
+                return self.only_upscale(upscale_model, image, rescale_method, upscale_by, monitor.report)
+
+        # Process Stage 1 (always upscale first), reusing cached results when only the stage 2 settings changed
+        stage1_result = None
+        if cache is not None:
+            cached = [cache.get(key) for key in stage1_keys]
+            if all(item is not None for item in cached):
+                stage1_result = (torch.cat([item[0] for item in cached]), cached[0][1])
+        if stage1_result is None:
+            if mixed_initial:
+                with monitor.stage("mixed_initial", images=images):
+                    image = self.create_mixed_initial(image, rescale_method, fast_mixed_initial)
+            with monitor.stage("stage1", images=images, tiled=tiled_upscale):
+                stage1_result = self.process_stage1(upscale_model, image, upscale_by, rescale_method, tiled_upscale, tile_settings, monitor.report)
+            if cache is not None:
+                for index, key in enumerate(stage1_keys):
+                    cache.put(key, (stage1_result[0][index:index + 1], stage1_result[1]))
+        else:
+            if mixed_initial:
+                monitor.skip("mixed_initial", images=images)
+            monitor.skip("stage1", images=images)
+            stage1_result = (stage1_result[0].to(image.device), stage1_result[1])
+
+        # Check if Stage 2 is needed
+        current_scale = stage1_result[1]
+        if current_scale < upscale_by:
+            # Process Stage 2
+            with monitor.stage("stage2", images=images, tiled=tiled_upscale, order=stage2_order, streamed=stream_settings is not None):
+                if stream_settings is not None:
+                    return self.process_stage2_streaming(upscale_model, stage1_result[0], upscale_by, current_scale, rescale_method,
+                                                         stage2_order == "upscale_first", tiled_upscale, tile_settings, *stream_settings,
+                                                         report=monitor.report)
+                return self.process_stage2(upscale_model, stage1_result[0], upscale_by, current_scale, rescale_method, stage2_order == "upscale_first", tiled_upscale, tile_settings,
+                                           monitor.report)
+        return stage1_result[0]
+
+
+    @staticmethod
+    def create_mixed_initial(image, method, fast=False):
+        if fast:
+            return get_mixed_initial(image, method)
+
         samples = image.movedim(-1, 1)
         upscaled = comfy.utils.common_upscale(samples, samples.shape[3] * 2, samples.shape[2] * 2, method, "disabled")
         downscaled = comfy.utils.common_upscale(upscaled, samples.shape[3], samples.shape[2], method, "disabled")
@@ -72,7 +488,7 @@ class Advanced_Upscale_Image_Using_Model:
 
 
     @classmethod
-    def only_upscale(self, upscale_model, image, rescale_method, upscale_by):
+    def only_upscale(self, upscale_model, image, rescale_method, upscale_by, report=None):
         samples = image.movedim(-1, 1)
         
         original_width, original_height = samples.shape[3], samples.shape[2]
@@ -80,7 +496,7 @@ class Advanced_Upscale_Image_Using_Model:
         target_width = round(original_width * upscale_by)
         target_height = round(original_height * upscale_by)
         
-        upscaled = ImageUpscaleWithModel().upscale(upscale_model, image)[0].movedim(-1, 1)
+        upscaled = self.full_upscaling(upscale_model, image, report)
         
         samples = comfy.utils.common_upscale(upscaled, target_width, target_height, rescale_method, "disabled")
         
@@ -88,18 +504,13 @@ class Advanced_Upscale_Image_Using_Model:
 
 
     @classmethod
-    def process_stage1(self, upscale_model, image, upscale_by, rescale_method, tiled_upscale):
-        print(f"🐐 Advanced Upscale: Initializing Stage 1 of upscaling.")
+    def process_stage1(self, upscale_model, image, upscale_by, rescale_method, tiled_upscale, tile_settings=(512, 32, 4), report=None):
         samples = image.movedim(-1, 1)
         original_width, original_height = samples.shape[3], samples.shape[2]
 
         # Upscale using the model
-        if tiled_upscale:
-            print(f"🐐 Advanced Upscale: Using tiled upscaling.")
-            upscaled = self.tiled_upscaling(upscale_model, image)
-        else:
-            upscaled = ImageUpscaleWithModel().upscale(upscale_model, image)[0].movedim(-1, 1)
-        
+        upscaled = self.model_upscale(upscale_model, image, tiled_upscale, tile_settings, report)
+
         achieved_scale = upscaled.shape[3] / original_width
 
         # If the achieved scale is more than needed, downscale
@@ -113,31 +524,27 @@ class Advanced_Upscale_Image_Using_Model:
 
 
     @classmethod
-    def process_stage2(self, upscale_model, image, upscale_by, current_scale, rescale_method, upscale_first, tiled_upscale):
-        print(f"🐐 Advanced Upscale: Initializing Stage 2 of upscaling.")
+    def process_stage2(self, upscale_model, image, upscale_by, current_scale, rescale_method, upscale_first, tiled_upscale, tile_settings=(512, 32, 4),
+                       report=None):
         samples = image.movedim(-1, 1)
         original_width, original_height = samples.shape[3], samples.shape[2]
         target_width = round(original_width * (upscale_by / current_scale))
         target_height = round(original_height * (upscale_by / current_scale))
 
         if upscale_first:
-            if tiled_upscale:
-                upscaled = self.tiled_upscaling(upscale_model, image)
-            else:
-                upscaled = ImageUpscaleWithModel().upscale(upscale_model, image)[0].movedim(-1, 1)
+            upscaled = self.model_upscale(upscale_model, image, tiled_upscale, tile_settings, report)
 
             if upscaled.shape[3] != target_width or upscaled.shape[2] != target_height:
                 samples = comfy.utils.common_upscale(upscaled, target_width, target_height, rescale_method, "disabled")
+            else:
+                samples = upscaled
         else:
             interim_width = round(original_width * (upscale_by / current_scale) / upscale_model.scale)
             interim_height = round(original_height * (upscale_by / current_scale) / upscale_model.scale)
 
             downscaled = comfy.utils.common_upscale(samples, interim_width, interim_height, rescale_method, "disabled")
 
-            if tiled_upscale:
-                upscaled = self.tiled_upscaling(upscale_model, downscaled.movedim(1, -1))
-            else:
-                upscaled = ImageUpscaleWithModel().upscale(upscale_model, downscaled.movedim(1, -1))[0].movedim(-1, 1)
+            upscaled = self.model_upscale(upscale_model, downscaled.movedim(1, -1), tiled_upscale, tile_settings, report)
 
             if upscaled.shape[3] != target_width or upscaled.shape[2] != target_height:
                 samples = comfy.utils.common_upscale(upscaled, target_width, target_height, rescale_method, "disabled")
@@ -148,94 +555,174 @@ class Advanced_Upscale_Image_Using_Model:
 
 
     @classmethod
-    def tiled_upscaling(self, upscale_model, image):
-        # Get image dimensions
-        _, height, width, channels = image.shape
-        
-        scale_factor = upscale_model.scale
+    def process_stage2_streaming(self, upscale_model, image, upscale_by, current_scale, rescale_method, upscale_first, tiled_upscale,
+                                 tile_settings=(512, 32, 4), band_height=512, temp_dir="", report=None):
+        # Same passes as process_stage2, run on overlapping horizontal bands of the stage 1 image and blended into a
+        # memory-mapped output, so only a single band of every intermediate is held in memory at a time
+        batch_size, height, width, channels = image.shape
+        target_width = round(width * (upscale_by / current_scale))
+        target_height = round(height * (upscale_by / current_scale))
+        interim_width = round(width * (upscale_by / current_scale) / upscale_model.scale)
+        interim_height = round(height * (upscale_by / current_scale) / upscale_model.scale)
+
+        band_height = min(band_height, height)
+        overlap = max(1, min(tile_settings[1], band_height - 1))
+        blend_range = round(overlap * target_height / height)
+        accumulator = Tile_Accumulator(target_height, target_width, channels, torch.float32, "sine", blend_range, batch_size, "cpu", "disk", temp_dir)
+
+        # Every band computes its share of the rows of the whole image passes, sampled on the grid of the whole image
+        model_input_height = height if upscale_first else interim_height
+        band_positions = get_tile_positions(height, band_height, overlap, 0)
+        for band_index, y in enumerate(band_positions):
+            comfy.model_management.throw_exception_if_processing_interrupted()
+            output_top = round(y * target_height / height)
+            output_bottom = round((y + band_height) * target_height / height)
+            band = image[:, y:y + band_height].movedim(-1, 1)
+
+            model_top = y
+            if not upscale_first:
+                model_top = round(y * interim_height / height)
+                band = resample_rows(band, height, interim_height, model_top, round((y + band_height) * interim_height / height), y, rescale_method)
+                if interim_width != width:
+                    band = comfy.utils.common_upscale(band, interim_width, band.shape[2], rescale_method, "disabled")
+
+            band_report = None
+            if report is not None:
+                band_report = lambda fraction, band_index=band_index: report((band_index + fraction) / len(band_positions))
+            upscaled = self.model_upscale(upscale_model, band.movedim(1, -1), tiled_upscale, tile_settings, band_report)
+
+            model_scale = upscaled.shape[2] / band.shape[2]
+            upscaled = resample_rows(upscaled, round(model_input_height * model_scale), target_height, output_top, output_bottom,
+                                     round(model_top * model_scale), rescale_method)
+            if upscaled.shape[3] != target_width:
+                upscaled = comfy.utils.common_upscale(upscaled, target_width, upscaled.shape[2], rescale_method, "disabled")
+
+            accumulator.add(upscaled.movedim(1, -1).to("cpu", torch.float32), 0, output_top)
+            del band, upscaled
+
+        return accumulator.finalize(image.dtype)
 
-        # Calculate tile size and overlap for both dimensions
-        tile_width = width // 2
-        tile_height = height // 2
-        overlap_w = max(min(tile_width // 8, 64), 8)
-        overlap_h = max(min(tile_height // 8, 64), 8)
 
-        # Ensure overlap is at least 1 pixel less than tile dimensions
-        overlap_w = max(1, min(overlap_w, tile_width - 1))
-        overlap_h = max(1, min(overlap_h, tile_height - 1))
-        
-        print(f"🐐 Advanced Upscale: Tile size: {tile_width}x{tile_height} | Overlap: {overlap_w}x{overlap_h}")
-
-        # Calculate coordinates for tiles
-        coords = [
-            (0, 0, tile_width + overlap_w, tile_height + overlap_h),
-            (width - tile_width - overlap_w, 0, width, tile_height + overlap_h),
-            (0, height - tile_height - overlap_h, tile_width + overlap_w, height),
-            (width - tile_width - overlap_w, height - tile_height - overlap_h, width, height)
-        ]
-
-        # Create and upscale tiles
-        upscaled_tiles = []
-        for i, (x1, y1, x2, y2) in enumerate(coords):
-            print(f"🐐 Advanced Upscale: Processing tile {i+1}/{len(coords)} - Coordinates: ({x1}, {y1}, {x2}, {y2})")
-            
-            tile = image[:, y1:y2, x1:x2, :]
-            upscaled_tile = ImageUpscaleWithModel().upscale(upscale_model, tile)[0]
-            upscaled_tiles.append(upscaled_tile)
-
-        # Calculate dimensions of upscaled image
-        upscaled_height = int(height * scale_factor)
-        upscaled_width = int(width * scale_factor)
-
-        # Create empty tensor for final upscaled image
-        upscaled_image = torch.zeros((1, upscaled_height, upscaled_width, channels), dtype=upscaled_tiles[0].dtype)
-        weight_sum = torch.zeros((1, upscaled_height, upscaled_width, channels), dtype=upscaled_tiles[0].dtype)
-
-        # Define the sine blending function
-        def sine_blend(t):
-            return 0.5 - 0.5 * math.cos(math.pi * t)
-
-        # Place and blend upscaled tiles
-        for i, (x1, y1, x2, y2) in enumerate(coords):
-            ux1, uy1, ux2, uy2 = [int(coord * scale_factor) for coord in (x1, y1, x2, y2)]
-            tile = upscaled_tiles[i]
-            
-            # Ensure we don't overshoot the final dimensions
-            ux2 = min(ux2, upscaled_width)
-            uy2 = min(uy2, upscaled_height)
-            
-            # Calculate the actual dimensions of the upscaled tile
-            actual_tile_height = uy2 - uy1
-            actual_tile_width = ux2 - ux1
-            
-            # Crop the tile to match the target dimensions
-            tile = tile[0, :actual_tile_height, :actual_tile_width, :]
-
-            # Calculate blending weights for each tile
-            weight_matrix = torch.ones((actual_tile_height, actual_tile_width, channels), dtype=tile.dtype)
-
-            # Apply blending based on overlap regions
-            for j in range(overlap_w * scale_factor):
-                blend_weight = sine_blend(float(j) / (overlap_w * scale_factor))
-                if x1 > 0:
-                    weight_matrix[:, j, :] *= blend_weight  # Left edge
-                if x2 < width:
-                    weight_matrix[:, -(j + 1), :] *= blend_weight  # Right edge
-            
-            for j in range(overlap_h * scale_factor):
-                blend_weight = sine_blend(float(j) / (overlap_h * scale_factor))
-                if y1 > 0:
-                    weight_matrix[j, :, :] *= blend_weight  # Top edge
-                if y2 < height:
-                    weight_matrix[-(j + 1), :, :] *= blend_weight  # Bottom edge
-            
-            # Add the weighted tile to the final image
-            upscaled_image[0, uy1:uy2, ux1:ux2, :] += tile * weight_matrix
-            weight_sum[0, uy1:uy2, ux1:ux2, :] += weight_matrix
-
-        # Normalize by the sum of the weights to avoid artifacts
-        upscaled_image = torch.where(weight_sum > 0, upscaled_image / weight_sum, upscaled_image)
-        return upscaled_image.movedim(-1, 1)
+    @classmethod
+    def model_upscale(self, upscale_model, image, tiled_upscale, tile_settings, report=None):
+        # One model pass over the image, returned channels first, report receives the finished fraction of tiled passes
+        if tiled_upscale:
+            return self.tiled_upscaling(upscale_model, image, *tile_settings, report=report)
+        return self.full_upscaling(upscale_model, image, report)
+
+
+    @staticmethod
+    def full_upscaling(upscale_model, image, report=None):
+        # The pass of ImageUpscaleWithModel, which creates a progress bar of its own that would replace the bar of the node
+        device = comfy.model_management.get_torch_device()
+        memory_required = comfy.model_management.module_size(upscale_model.model)
+        memory_required += (512 * 512 * 3) * image.element_size() * max(upscale_model.scale, 1.0) * 384.0
+        memory_required += image.nelement() * image.element_size()
+        comfy.model_management.free_memory(memory_required, device)
+        upscale_model.to(device)
+
+        samples = image.movedim(-1, -3).to(device)
+        tile = 512
+        overlap = 32
+        try:
+            while True:
+                try:
+                    steps = samples.shape[0] * comfy.utils.get_tiled_scale_steps(samples.shape[3], samples.shape[2], tile_x=tile, tile_y=tile, overlap=overlap)
+                    upscaled = comfy.utils.tiled_scale(samples, lambda a: upscale_model(a), tile_x=tile, tile_y=tile, overlap=overlap,
+                                                       upscale_amount=upscale_model.scale, pbar=Report_Progress_Bar(steps, report))
+                    break
+                except comfy.model_management.OOM_EXCEPTION:
+                    # Same fallback as ImageUpscaleWithModel, smaller tiles down to 128 pixels
+                    tile //= 2
+                    if tile < 128:
+                        raise
+        finally:
+            upscale_model.to("cpu")
+        return torch.clamp(upscaled, min=0, max=1.0)
+
+
+    @staticmethod
+    def upscale_tiles(upscale_model, tiles, batch_size):
+        # Runs equally sized tiles through the model in batches and yields each upscaled batch on the model device
+        device = comfy.model_management.get_torch_device()
+        memory_required = comfy.model_management.module_size(upscale_model.model)
+        memory_required += tiles[:batch_size].nelement() * tiles.element_size() * max(upscale_model.scale, 1.0) * 384.0
+        comfy.model_management.free_memory(memory_required, device)
+        upscale_model.to(device)
+
+        start = 0
+        try:
+            while start < tiles.shape[0]:
+                # Cancelling the queue takes effect between model passes
+                comfy.model_management.throw_exception_if_processing_interrupted()
+                batch = tiles[start:start + batch_size].movedim(-1, -3).to(device)
+                try:
+                    upscaled = upscale_model(batch)
+                except comfy.model_management.OOM_EXCEPTION:
+                    # Retry the same tiles in smaller batches before giving up
+                    if batch_size == 1:
+                        raise
+                    batch_size //= 2
+                    print(f"🐐 Advanced Upscale: Out of memory, reducing tile batch size to {batch_size}.")
+                    continue
+
+                start += batch.shape[0]
+                # Autocast returns lower precision outputs, blending happens in the precision of the tiles
+                yield torch.clamp(upscaled.movedim(-3, -1).to(tiles.dtype), min=0, max=1.0)
+        finally:
+            upscale_model.to("cpu")
+
+
+    @classmethod
+    def tiled_upscaling(self, upscale_model, image, tile_size=512, tile_overlap=32, tile_batch_size=4, report=None):
+        # Get image dimensions
+        batch_size, height, width, channels = image.shape
+
+        # Tiles are at most tile_size large, with the overlap kept below the tile dimensions
+        tile_width = min(tile_size, width)
+        tile_height = min(tile_size, height)
+        overlap_w = max(1, min(tile_overlap, tile_width - 1))
+        overlap_h = max(1, min(tile_overlap, tile_height - 1))
+
+        tile_plan = plan_tiles(width, height, tile_width, tile_height, overlap_w, overlap_h, 0, 0, "row")
+        tile_coordinates = tile_plan.coordinates
+
+        grid_rows, grid_cols = tile_plan.grid_size
+        print(f"🐐 Advanced Upscale: {grid_cols}x{grid_rows} tiles of {tile_width}x{tile_height} | Overlap: {overlap_w}x{overlap_h} | Batch size: {tile_batch_size}")
+
+        # Order the tiles tile by tile instead of image by image, so each tile position completes for the whole batch in turn
+        tiles = extract_tiles(image, tile_coordinates, tile_width, tile_height)
+        tiles = tiles.unflatten(0, (batch_size, len(tile_coordinates))).transpose(0, 1).flatten(0, 1)
+
+        accumulator = None
+        pending = None
+        tile_index = 0
+        finished_tiles = 0
+        for upscaled in self.upscale_tiles(upscale_model, tiles, tile_batch_size):
+            finished_tiles += upscaled.shape[0]
+            if report is not None:
+                report(finished_tiles / tiles.shape[0])
+            pending = upscaled if pending is None else torch.cat([pending, upscaled])
+
+            if accumulator is None:
+                # Derive the scale from the model output, which also covers models with non-integer scales
+                scale_h = upscaled.shape[1] / tile_height
+                scale_w = upscaled.shape[2] / tile_width
+                upscaled_height, upscaled_width = round(height * scale_h), round(width * scale_w)
+                blend_range = round(min(overlap_w * scale_w, overlap_h * scale_h))
+                accumulator = Tile_Accumulator(upscaled_height, upscaled_width, channels, upscaled.dtype, "sine", blend_range, batch_size, upscaled.device)
+
+            # Blend every tile position as soon as it is upscaled for all images of the batch
+            while pending.shape[0] >= batch_size:
+                x, y = tile_coordinates[tile_index]
+                ux, uy = round(x * scale_w), round(y * scale_h)
+                # Crop tiles that overshoot the final dimensions due to rounding
+                accumulator.add(pending[:batch_size, :upscaled_height - uy, :upscaled_width - ux], ux, uy)
+                pending = pending[batch_size:]
+                tile_index += 1
+
+        upscaled_image = accumulator.finalize()
+        return upscaled_image.to(image.device).movedim(-1, 1)
 
 
 NODE_CLASS_MAPPINGS = {
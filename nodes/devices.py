@@ -0,0 +1,24 @@
+import torch  # type: ignore
+
+
+DTYPES = {
+    "float32": torch.float32,
+    "float64": torch.float64,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def get_device(device, auto_device=None, name="GOAT Nodes"):
+    # Resolves a device option, "auto" picks auto_device when given and otherwise CUDA whenever it is available
+    if device == "auto":
+        device = auto_device if auto_device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(device)
+    if device.type == "cuda":
+        if not torch.cuda.is_available():
+            print(f"🐐 {name}: CUDA is not available, falling back to the CPU.")
+            return torch.device("cpu")
+        # Tensors always report an index, so a bare "cuda" would never compare equal to their device
+        if device.index is None:
+            return torch.device("cuda", torch.cuda.current_device())
+    return device
@@ -1,4 +1,5 @@
 import torch
+from ComfyUI_GOAT_Nodes.nodes.devices import get_device # type: ignore
 
 
 def supports_amp():
@@ -27,100 +28,77 @@ class Fast_Color_Match:
     FUNCTION = "exec"
     CATEGORY = '🐐 GOAT Nodes/Postprocessing'
     DESCRIPTION = '''
-    Matches the colors of the image to those of a reference image.
+    Matches the colors of the image to those of a reference image. The whole batch is matched at once, one reference is applied to every image, otherwise at least as many references as images are needed.
     '''
 
 
-    def match_channel(self, input_channel, ref_channel, strength, adaptive_enabled):
-        # Fixed base strength
-        base_strength = 1.0
+    @staticmethod
+    def get_matching_device(device):
+        # Auto only picks the GPU when it supports AMP
+        return get_device(device, "cuda" if supports_amp() else "cpu", "Fast Color Match")
 
-        # Calculate means and standard deviations
-        input_mean = input_channel.float().mean()
-        input_std = input_channel.float().std()
-        ref_mean = ref_channel.float().mean()
-        ref_std = ref_channel.float().std()
 
-        # Normalize the input channel
-        normalized = (input_channel - input_mean) / (input_std + 1e-8)
+    @staticmethod
+    def get_match_transform(image, reference, strength, adaptive_enabled):
+        # Per image and channel statistics of the (B, H, W, C) tensors, one reduction each for the whole batch
+        input_std, input_mean = torch.std_mean(image, dim=(1, 2), keepdim=True)
+        ref_std, ref_mean = torch.std_mean(reference, dim=(1, 2), keepdim=True)
 
-        # Create the matched channel based on the reference stats
-        matched_channel = normalized * ref_std + ref_mean
+        # A single reference matches every image of the batch, otherwise image i is matched to reference i
+        if reference.shape[0] != 1:
+            if reference.shape[0] < image.shape[0]:
+                raise ValueError(f"reference: {reference.shape[0]} images are fewer than the {image.shape[0]} images to match, use 1 or at least {image.shape[0]}")
+            ref_std, ref_mean = ref_std[:image.shape[0]], ref_mean[:image.shape[0]]
+
+        # Normalizing to the input stats and rescaling to the reference stats is one affine map per channel
+        scale = ref_std / (input_std + 1e-8)
+        shift = ref_mean - input_mean * scale
 
         # Compute adaptive strength if enabled
         if adaptive_enabled == True:
-            # Calculate differences for adaptive strength
-            mean_diff = torch.abs(input_mean - ref_mean)
-            std_diff = torch.abs(input_std - ref_std)
-
             # Use weights for differences
             weight_mean = 2.0  # Weight for mean difference
             weight_std = 1.0   # Weight for standard deviation difference
 
             # Compute the adjustment factor based on differences
+            mean_diff = torch.abs(input_mean - ref_mean)
+            std_diff = torch.abs(input_std - ref_std)
             adjustment_factor = (weight_mean * mean_diff + weight_std * std_diff) / (weight_mean + weight_std + 1e-5)
 
-            # Compute adaptive strength based on the base strength and adjustment factor
-            adaptive_strength = base_strength * (1 - adjustment_factor)
-
-            # Scale adaptive strength by the input strength parameter
-            final_strength = strength * adaptive_strength
-            
-            # Clamp final strength between 0 and 1
-            final_strength = torch.clamp(final_strength, 0, 1)
-
+            # Scale the fixed base strength of 1 by the input strength parameter and clamp it between 0 and 1
+            final_strength = torch.clamp(strength * (1 - adjustment_factor), 0, 1)
         else:
             # If adaptive strength is disabled, just use fixed strength
             final_strength = strength
 
-        # Perform linear interpolation with final strength
-        return torch.lerp(input_channel, matched_channel, final_strength)
+        # lerp(x, x * scale + shift, s) folded into a single multiply-add
+        return 1 + final_strength * (scale - 1), final_strength * shift
 
 
     def exec(self, image, reference, strength, adaptive_matching, device):
         if strength == 0:
             return (image,)
 
-        amp_enabled = supports_amp()
-        if amp_enabled == False and device == "cuda":
-            amp_enabled == True
-        elif amp_enabled == True and device == "cpu":
-            amp_enabled == False
-
-        if amp_enabled:
-            image = image.cuda()
-            reference = reference.cuda()
+        original_device, original_dtype = image.device, image.dtype
+        matching_device = self.get_matching_device(device)
 
         # Ensure inputs are float tensors in range [0, 1]
+        image = image.to(matching_device)
+        reference = reference.to(matching_device)
         image = image.float() / 255.0 if image.dtype == torch.uint8 else image.float()
         reference = reference.float() / 255.0 if reference.dtype == torch.uint8 else reference.float()
 
-        matched_images = []
-        for i in range(image.shape[0]):
-            img = image[i].permute(2, 0, 1)  # (H, W, C) -> (C, H, W)
-            ref = reference[i].permute(2, 0, 1)  # (H, W, C) -> (C, H, W)
-
-            # Use autocast to enable mixed precision
-            with torch.cuda.amp.autocast(enabled=amp_enabled):
-                # Match each channel separately with fixed base strength and input strength
-                matched_r = self.match_channel(img[0], ref[0], strength, adaptive_matching)
-                matched_g = self.match_channel(img[1], ref[1], strength, adaptive_matching)
-                matched_b = self.match_channel(img[2], ref[2], strength, adaptive_matching)
-
-                # Reconstruct the image by stacking the matched channels
-                matched_image = torch.stack([matched_r, matched_g, matched_b], dim=0)  # Shape (C, H, W)
-                matched_image = matched_image.permute(1, 2, 0)  # (C, H, W) -> (H, W, C)
-
-            matched_images.append(matched_image)
-
-        # Stack the processed images back into a batch
-        result = torch.stack(matched_images, dim=0)
+        # Only the color channels are matched, an alpha channel is passed through
+        colors = image[..., :3]
+        multiplier, offset = self.get_match_transform(colors, reference[..., :3], strength, adaptive_matching)
 
+        result = image.clone() if image.shape[3] > 3 else torch.empty_like(image)
         # Ensure the output is in the range [0, 1]
-        result = torch.clamp(result, 0, 1).cpu()
+        torch.addcmul(offset, colors, multiplier, out=result[..., :3]).clamp_(0, 1)
+        result = result.to(original_device)
 
         # Convert back to the original format (uint8 if it was originally uint8)
-        if image.dtype == torch.uint8:
+        if original_dtype == torch.uint8:
             result = (result * 255.0).round().byte()
 
         return (result,)
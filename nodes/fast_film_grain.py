@@ -1,148 +1,264 @@
 import torch
+import torch.nn.functional as F
+import functools
+import hashlib
+import math
+import time
+import threading
+import concurrent.futures
+from ComfyUI_GOAT_Nodes.nodes.result_cache import Result_Cache, get_cache_key # type: ignore
+from ComfyUI_GOAT_Nodes.nodes.devices import DTYPES, get_device # type: ignore
+
+
+LOW_PASS_SIGMA = 0.01  # Adjust 0.01 to control filter strength
+
+
+@functools.lru_cache(maxsize=16)
+def get_low_pass_filter(height, width, sigma, device, dtype):
+    # Gaussian low-pass over the rfft2 half spectrum, shaped to broadcast over (batch, height, width // 2 + 1, channels)
+    y_freq = torch.fft.fftfreq(height, device=device, dtype=dtype)[:, None]
+    x_freq = torch.fft.rfftfreq(width, device=device, dtype=dtype)[None, :]
+    return torch.exp(-(x_freq**2 + y_freq**2) / (2 * sigma**2)).unsqueeze(-1)
+
+
+def filter_noise_fft(noise, sigma=LOW_PASS_SIGMA):
+    # The filter is real and symmetric, so the half spectrum of rfft2 holds all of it and irfft2 returns the real part directly
+    # Frames are filtered one at a time: rfft2 rounds a single frame differently than a batch, so this keeps the grain of a
+    # frame independent of how the batch is chunked, and bounds the temporaries of irfft2 to one frame
+    batch, height, width, channels = noise.shape
+    low_pass_filter = get_low_pass_filter(height, width, sigma, noise.device, noise.dtype)
+
+    filtered = None
+    for index in range(batch):
+        noise_fft = torch.fft.rfft2(noise[index:index + 1], dim=(1, 2))
+        noise_fft *= low_pass_filter
+        frame = torch.fft.irfft2(noise_fft, s=(height, width), dim=(1, 2))
+        if batch == 1:
+            return frame
+        if filtered is None:
+            # Same channel-planar layout as irfft2 returns, so the per frame mean sums in the same order as for a single frame
+            filtered = torch.empty((batch, channels, height, width), dtype=frame.dtype, device=frame.device).permute(0, 2, 3, 1)
+        filtered[index] = frame[0]
+    return filtered
+
+
+def get_spatial_radius(sigma):
+    # A Gaussian of sigma cycles per pixel is a Gaussian of 1 / (2 pi sigma) pixels in space, truncated at 5 standard
+    # deviations, where the dropped two-sided tail (about 5e-7 of the weight at radius 80) is below what the grain strength can show
+    return math.ceil(5 / (2 * math.pi * sigma))
+
+
+@functools.lru_cache(maxsize=16)
+def get_spatial_kernel(sigma, device, dtype):
+    spatial_sigma = 1 / (2 * math.pi * sigma)
+    radius = get_spatial_radius(sigma)
+    offsets = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    kernel = torch.exp(-offsets**2 / (2 * spatial_sigma**2))
+    # Unit sum keeps the zero frequency untouched, like the FFT filter
+    return (kernel / kernel.sum()).to(device, dtype)
+
+
+def filter_noise_spatial(noise, sigma=LOW_PASS_SIGMA):
+    # Same filter as two 1D convolutions, circular padding reproduces the wrap-around of the FFT filter
+    batch, height, width, channels = noise.shape
+    kernel = get_spatial_kernel(sigma, noise.device, noise.dtype)
+    radius = kernel.shape[0] // 2
+
+    samples = noise.permute(0, 3, 1, 2).reshape(batch * channels, 1, height, width)
+    samples = F.conv2d(F.pad(samples, (0, 0, radius, radius), mode="circular"), kernel.view(1, 1, -1, 1))
+    samples = F.conv2d(F.pad(samples, (radius, radius, 0, 0), mode="circular"), kernel.view(1, 1, 1, -1))
+    return samples.reshape(batch, channels, height, width).permute(0, 2, 3, 1)
+
+
+def supports_spatial_filter(height, width, sigma=LOW_PASS_SIGMA):
+    # Circular padding cannot wrap around more than the image itself
+    return min(height, width) > get_spatial_radius(sigma)
+
+
+@functools.lru_cache(maxsize=64)
+def get_auto_filter_method(height, width, channels, device, dtype, sigma=LOW_PASS_SIGMA):
+    # Built-in calibration: times both filters once on a single frame of this size and device and keeps the faster one
+    if not supports_spatial_filter(height, width, sigma):
+        return "fft"
+
+    noise = torch.zeros((1, height, width, channels), device=device, dtype=dtype)
+    timings = {}
+    for method, filter_function in (("fft", filter_noise_fft), ("spatial", filter_noise_spatial)):
+        # The first call warms up FFT plans, kernels and the filter caches
+        filter_function(noise, sigma)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        filter_function(noise, sigma)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        timings[method] = time.perf_counter() - start
+
+    method = min(timings, key=timings.get)
+    print(f"🐐 Fast Film Grain: Using the {method} filter for {width}x{height} on {device.type} (fft {timings['fft'] * 1000:.1f} ms, spatial {timings['spatial'] * 1000:.1f} ms)")
+    return method
+
+
+def filter_noise(noise, sigma=LOW_PASS_SIGMA, method="fft"):
+    batch, height, width, channels = noise.shape
+    if method == "auto":
+        method = get_auto_filter_method(height, width, channels, noise.device, noise.dtype, sigma)
+    if method == "spatial" and supports_spatial_filter(height, width, sigma):
+        return filter_noise_spatial(noise, sigma)
+    return filter_noise_fft(noise, sigma)
+
+
+GRAIN_MULTIPLIERS = {
+    "gaussian": 0.5,
+    "fft": 5,
+    "mixed": 2.5,
+}
 
 
-def supports_amp():
-    # Check if the GPU supports AMP (requires compute capability >= 7.0)
-    if torch.cuda.is_available():
-        capability = torch.cuda.get_device_capability()
-        return capability[0] >= 7  # AMP is supported on compute capability 7.0 and above (Volta and newer)
-    return False
-
-
-def apply_gaussian_grain_(image, strength, seed, multiplier):
-    mul_strength = strength * multiplier
-    torch.manual_seed(seed)
-    noise = torch.randn_like(image) * mul_strength
-    return torch.clamp(image + noise, 0, 1)
-
-
-def apply_gaussian_grain_cuda(image, strength, seed, multiplier):
-    mul_strength = strength * multiplier
-    # Check if AMP is supported
-    amp_enabled = supports_amp()
-
-    # Use autocast only if AMP is supported
-    with torch.cuda.amp.autocast(enabled=amp_enabled):
-        image = image.cuda()
-        torch.manual_seed(seed)
-        noise = torch.randn_like(image) * mul_strength
-        return torch.clamp(image + noise, 0, 1).cpu()
-
-
-def apply_fft_grain(image, strength, seed, multiplier):
-    torch.manual_seed(seed)
-    noise = torch.randn_like(image)
-    
-    mul_strength = strength * multiplier
-
-    # FFT of noise
-    noise_fft = torch.fft.fft2(noise, dim=(1, 2))
-    
-    # Create a proper low-pass filter
-    height, width = image.shape[1], image.shape[2]
-    y_freq = torch.fft.fftfreq(height)[:, None]
-    x_freq = torch.fft.fftfreq(width)[None, :]
-    dist = torch.sqrt(x_freq**2 + y_freq**2)
-    low_pass_filter = torch.exp(-dist**2 / (2 * 0.01**2))  # Adjust 0.01 to control filter strength
-    
-    # Expand dimensions to match noise_fft
-    low_pass_filter = low_pass_filter.unsqueeze(0).unsqueeze(-1).expand_as(noise_fft)
-
-    # Apply low-pass filter
-    filtered_noise_fft = noise_fft * low_pass_filter
-    filtered_noise = torch.fft.ifft2(filtered_noise_fft, dim=(1, 2)).real
-
-    grain = (filtered_noise - filtered_noise.mean()) * mul_strength
-    return torch.clamp(image + grain, 0, 1)
-
-
-def apply_fft_grain_cuda(image, strength, seed, multiplier):
-    # Check if AMP is supported
-    amp_enabled = supports_amp()
-
-    with torch.cuda.amp.autocast(enabled=amp_enabled):
-        image = image.cuda()
-        torch.manual_seed(seed)
-        noise = torch.randn_like(image)
-
-        mul_strength = strength * multiplier
-
-        noise_fft = torch.fft.fft2(noise, dim=(1, 2))
-
-        height, width = image.shape[1], image.shape[2]
-        y_freq = torch.fft.fftfreq(height).cuda()[:, None]
-        x_freq = torch.fft.fftfreq(width).cuda()[None, :]
-        dist = torch.sqrt(x_freq**2 + y_freq**2)
-        low_pass_filter = torch.exp(-dist**2 / (2 * 0.01**2))
-
-        low_pass_filter = low_pass_filter.unsqueeze(0).unsqueeze(-1).expand_as(noise_fft)
-
-        filtered_noise_fft = noise_fft * low_pass_filter
-        filtered_noise = torch.fft.ifft2(filtered_noise_fft, dim=(1, 2)).real
+def get_frame_seeds(seed, frame_count, first_frame=0):
+    # The first frame keeps the seed itself, so single images grain exactly as before, later frames get well mixed seeds
+    # Seeds only depend on the frame index in the batch, so chunks of a batch get the same seeds as the whole batch
+    return [
+        seed if index == 0 else int.from_bytes(hashlib.blake2b(f"{seed}:{index}".encode(), digest_size=8).digest(), "little")
+        for index in range(first_frame, first_frame + frame_count)
+    ]
 
-        grain = (filtered_noise - filtered_noise.mean()) * mul_strength
-        return torch.clamp(image + grain, 0, 1).cpu()
 
+def generate_noise(shape, dtype, seed, device, out=None, first_frame=0):
+    # A dedicated generator seeded per frame leaves the global RNG state alone and makes each frame reproducible on its own
+    noise = out if out is not None else torch.empty(shape, dtype=dtype, device=device)
+    generator = torch.Generator(device=device)
+    for index, frame_seed in enumerate(get_frame_seeds(seed, shape[0], first_frame)):
+        generator.manual_seed(frame_seed)
+        noise[index].normal_(generator=generator)
+    return noise
 
-def apply_mixed_grain(image, strength, seed, multiplier):
-    torch.manual_seed(seed)
-    noise = torch.randn_like(image)
 
-    # FFT of noise
-    noise_fft = torch.fft.fft2(noise, dim=(1, 2))
-    
-    mul_strength = strength * multiplier
-    noise_mix = 0.2
-    
-    # Create a proper low-pass filter
-    height, width = image.shape[1], image.shape[2]
-    y_freq = torch.fft.fftfreq(height)[:, None]
-    x_freq = torch.fft.fftfreq(width)[None, :]
-    dist = torch.sqrt(x_freq**2 + y_freq**2)
-    low_pass_filter = torch.exp(-dist**2 / (2 * 0.01**2))  # Adjust 0.01 to control filter strength
-    
-    # Expand dimensions to match noise_fft
-    low_pass_filter = low_pass_filter.unsqueeze(0).unsqueeze(-1).expand_as(noise_fft)
-
-    # Apply low-pass filter
-    filtered_noise_fft = noise_fft * low_pass_filter
-    filtered_noise = torch.fft.ifft2(filtered_noise_fft, dim=(1, 2)).real
+def generate_grain(shape, dtype, seed, grain, device, filter_method="fft", out=None, first_frame=0):
+    # Unscaled grain: plain noise for gaussian, low-pass filtered (and mixed) noise around zero for fft and mixed
+    # Everything after the filter works in place on the filtered noise
+    noise = generate_noise(shape, dtype, seed, device, out, first_frame)
+    if grain == "gaussian":
+        return noise
 
-    # Mix random noise with filtered noise
-    mixed_noise = noise_mix * noise + (1 - noise_mix) * filtered_noise
-    grain = (mixed_noise - mixed_noise.mean()) * mul_strength
-    return torch.clamp(image + grain, 0, 1)
-
-
-def apply_mixed_grain_cuda(image, strength, seed, multiplier):
-    # Check if AMP is supported
-    amp_enabled = supports_amp()
-    if amp_enabled == True: print("AMP is enabled")
-
-    with torch.cuda.amp.autocast(enabled=amp_enabled):
-        image = image.cuda()
-        torch.manual_seed(seed)
-        noise = torch.randn_like(image)
-
-        noise_fft = torch.fft.fft2(noise, dim=(1, 2))
+    # Low-pass filter the noise
+    filtered_noise = filter_noise(noise, method=filter_method)
 
+    if grain == "mixed":
+        # Mix random noise with filtered noise in the noise buffer, rounded and laid out like the separate products and sum
+        # this replaces, so the mean below sums in the same order
         noise_mix = 0.2
-        mul_strength = strength * multiplier
-
-        height, width = image.shape[1], image.shape[2]
-        y_freq = torch.fft.fftfreq(height).cuda()[:, None]
-        x_freq = torch.fft.fftfreq(width).cuda()[None, :]
-        dist = torch.sqrt(x_freq**2 + y_freq**2)
-        low_pass_filter = torch.exp(-dist**2 / (2 * 0.01**2))
-
-        low_pass_filter = low_pass_filter.unsqueeze(0).unsqueeze(-1).expand_as(noise_fft)
-
-        filtered_noise_fft = noise_fft * low_pass_filter
-        filtered_noise = torch.fft.ifft2(filtered_noise_fft, dim=(1, 2)).real
-
-        mixed_noise = noise_mix * noise + (1 - noise_mix) * filtered_noise
-        grain = (mixed_noise - mixed_noise.mean()) * mul_strength
-        return torch.clamp(image + grain, 0, 1).cpu()
+        filtered_noise = noise.mul_(noise_mix).add_(filtered_noise.mul_(1 - noise_mix))
+
+    # Centering each frame on its own keeps the grain of a frame independent of the rest of the batch
+    return filtered_noise.sub_(filtered_noise.mean(dim=(1, 2, 3), keepdim=True))
+
+
+def add_grain(source, grain_noise, scale, output_dtype=None, out=None):
+    # Scales the grain in place and writes the sum straight into the output, which is then clamped in place
+    grain_noise.mul_(scale)
+    if out is None:
+        out = torch.empty(source.shape, dtype=output_dtype or source.dtype, device=source.device)
+    if out.dtype != source.dtype:
+        # An add into an output of another precision goes through a temporary of the input precision, the grain buffer
+        # already is one, so the sum is formed there and only converted on the copy
+        return out.copy_(grain_noise.add_(source).clamp_(0, 1))
+    return torch.add(source, grain_noise, out=out).clamp_(0, 1)
+
+
+PLATE_MAX_SIZE = 1024
+TEXTURE_BANK = Result_Cache(512 * 1024 ** 2, prefix="goat_grain", name="Fast Film Grain")
+
+
+def get_plate_size(height, width):
+    # Resolution class of an image: the next power of two of its longer side, capped so the plates stay small
+    return min(1 << (max(height, width) - 1).bit_length(), PLATE_MAX_SIZE)
+
+
+def get_texture_bank(seed, grain, plate_size, channels, plate_count, dtype, device, bank_dir="", filter_method="fft"):
+    TEXTURE_BANK.configure(TEXTURE_BANK.budget_bytes, bank_dir)
+    key = get_cache_key(seed, grain, plate_size, channels, plate_count, str(dtype), filter_method)
+    cached = TEXTURE_BANK.get(key)
+    if cached is not None:
+        return cached[0].to(device)
+
+    # Filtering through the FFT is circular, so every plate wraps around seamlessly and can be tiled
+    plates = generate_grain((plate_count, plate_size, plate_size, channels), dtype, seed, grain, device, filter_method)
+    TEXTURE_BANK.put(key, (plates,))
+    return plates
+
+
+def sample_texture_bank(bank, frame_count, height, width, seed, first_frame=0):
+    # Every frame reads one plate at a random wrap-around offset, optionally flipped, drawn from its own seed
+    plate_count, plate_size = bank.shape[0], bank.shape[1]
+    generator = torch.Generator()
+    plates, rows, cols = [], [], []
+    for frame_seed in get_frame_seeds(seed, frame_count, first_frame):
+        generator.manual_seed(frame_seed)
+        plate, y, x, flip_y, flip_x = torch.randint(0, plate_count * plate_size * 2, (5,), generator=generator).tolist()
+        row = (torch.arange(height) + y) % plate_size
+        col = (torch.arange(width) + x) % plate_size
+        plates.append(plate % plate_count)
+        rows.append(row.flip(0) if flip_y % 2 else row)
+        cols.append(col.flip(0) if flip_x % 2 else col)
+
+    device = bank.device
+    plates = torch.tensor(plates, device=device)[:, None, None]
+    rows = torch.stack(rows).to(device)[:, :, None]
+    cols = torch.stack(cols).to(device)[:, None, :]
+    return bank[plates, rows, cols]
+
+
+def apply_grain(image, strength, seed, grain, device="auto", filter_method="fft", output_dtype=None, bank_settings=None, chunk_size=0,
+                workers=1):
+    # Frames are grained in chunks straight into a preallocated output, CPU chunks run on a thread pool
+    # Every worker reuses its own noise buffer, so memory is bound by chunk_size * workers instead of the batch size
+    device = get_device(device, name="Fast Film Grain")
+    frame_count, height, width, channels = image.shape
+    chunk_size = min(chunk_size, frame_count) if chunk_size > 0 else frame_count
+    scale = strength * GRAIN_MULTIPLIERS[grain]
+
+    bank = None
+    if bank_settings is not None:
+        # Plates are synthesized once per seed, grain mode and resolution class, so each frame only costs a gather and an add
+        plate_count, bank_dir = bank_settings
+        bank_seed = int.from_bytes(hashlib.blake2b(f"{seed}:bank".encode(), digest_size=8).digest(), "little")
+        bank = get_texture_bank(bank_seed, grain, get_plate_size(height, width), channels, plate_count, image.dtype, device, bank_dir,
+                                filter_method)
+
+    output = torch.empty(image.shape, dtype=output_dtype or image.dtype, device=image.device)
+    buffers = threading.local()
+
+    def process(start):
+        source = image[start:start + chunk_size].to(device)
+        if bank is not None:
+            grain_noise = sample_texture_bank(bank, source.shape[0], height, width, seed, start)
+        else:
+            noise = getattr(buffers, "noise", None)
+            if noise is None:
+                noise = buffers.noise = torch.empty((chunk_size,) + tuple(source.shape[1:]), dtype=source.dtype, device=device)
+            grain_noise = generate_grain(source.shape, source.dtype, seed, grain, device, filter_method, noise[:source.shape[0]], start)
+
+        target = output[start:start + source.shape[0]]
+        if target.device == device:
+            add_grain(source, grain_noise, scale, out=target)
+        else:
+            target.copy_(add_grain(source, grain_noise, scale, output_dtype))
+
+    starts = range(0, frame_count, chunk_size)
+    if workers > 1 and device.type == "cpu" and len(starts) > 1:
+        # Torch ops already run on all cores, so the workers split its thread pool instead of each using all of it
+        torch_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, torch_threads // workers))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                list(executor.map(process, starts))
+        finally:
+            torch.set_num_threads(torch_threads)
+    else:
+        for start in starts:
+            process(start)
+    return output
 
 
 class Fast_Film_Grain:
@@ -154,6 +270,14 @@ class Fast_Film_Grain:
                 "strength": ("FLOAT", {"default": 0.1, "min": 0, "max": 1.0, "step": 0.01}),
                 "grain": (["gaussian", "gaussian_cuda", "fft", "fft_cuda", "mixed", "mixed_cuda"], {"default": "mixed_cuda"}),
                 "seed": ("INT", {"default": 0, "min": 0, "max": 1125899906842624}),
+                "device": (["auto", "cpu", "cuda"], {"default": "cpu"}),
+                "texture_bank": ("BOOLEAN", {"default": False}),
+                "bank_plates": ("INT", {"default": 8, "min": 1, "max": 64}),
+                "bank_dir": ("STRING", {"default": ""}),
+                "filter_method": (["fft", "spatial", "auto"], {"default": "fft"}),
+                "output_dtype": (["float32", "float16", "bfloat16"], {"default": "float32"}),
+                "stream_chunk_size": ("INT", {"default": 0, "min": 0, "max": 4096}),
+                "stream_workers": ("INT", {"default": 1, "min": 1, "max": 64}),
             },
         }
 
@@ -162,33 +286,32 @@ class Fast_Film_Grain:
     FUNCTION = "exec"
     CATEGORY = '🐐 GOAT Nodes/Postprocessing'
     DESCRIPTION = '''
-    Applies film grain to the image with a strength between 0 and 1. \n
+    Applies film grain to the image with a strength between 0 and 1. Every frame of a batch gets its own grain, reproducible from the seed.\n
     ‣ gaussian | Simple and fast noise generation.\n
-    ‣ gaussian_cuda | Simplest and fastest noise generation. (GPU accelerated)\n
-    ‣ fft | Random noise generation with low-pass filtering using Fast Fourier transform.\n
-    ‣ fft_cuda | Random noise generation with low-pass filtering using Fast Fourier transform. (GPU accelerated)\n
+    ‣ fft | Random noise generation with low-pass filtering using Fast Fourier transform. The filter runs on the half spectrum of a real transform, which moves single pixels of fft and mixed grain by up to 1 ulp (6e-8) compared to versions that used the full complex transform.\n
     ‣ mixed | Mixed noise generation combining both gaussian and ftt.\n
-    ‣ mixed_cuda | Mixed noise generation combining both gaussian and ftt. (GPU accelerated)\n
+    ‣ gaussian_cuda, fft_cuda, mixed_cuda | Same as above on the GPU, kept for existing workflows. Equivalent to device cuda.\n
+    ‣ device | Device the grain is generated on. auto uses the GPU when available. The image is returned on its original device.\n
+    ‣ texture_bank | Synthesizes a few tileable grain plates once per seed, grain and resolution class and reads every frame from a random plate, offset and flip. Much faster for long frame sequences, the grain stays varied between frames.\n
+    ‣ bank_plates | (texture bank) Amount of plates in the bank.\n
+    ‣ bank_dir | (texture bank, optional) Directory that evicted banks spill to instead of being dropped.\n
+    ‣ filter_method | (fft, mixed) How the low-pass filter is applied. fft filters in the frequency domain. spatial applies the same filter as a separable convolution, which matches fft up to the truncation of its kernel (about 5e-7 of its weight, under 2e-7 absolute difference in the grain). auto times both once per image size and device and uses the faster one.\n
+    ‣ output_dtype | Precision of the returned image. Lower precisions halve the size of the output, the grain itself is computed in the precision of the input.\n
+    ‣ stream_chunk_size | Amount of frames grained together. Memory is bound by the chunk size instead of the batch size. 0 processes the whole batch at once.\n
+    ‣ stream_workers | (streamed, CPU) Amount of chunks grained in parallel. The torch threads are split between the workers, so more workers only help when single chunks do not keep all cores busy.\n
     '''
 
 
-    def exec(self, image, strength, grain, seed):
-        grained_image = image
+    def exec(self, image, strength, grain, seed, device="cpu", texture_bank=False, bank_plates=8, bank_dir="", filter_method="fft",
+             output_dtype="float32", stream_chunk_size=0, stream_workers=1):
         scaled_strength = strength * 0.25
-        
-        if grain == "gaussian":
-            grained_image = apply_gaussian_grain_(image, scaled_strength, seed, 0.5)
-        elif grain == "gaussian_cuda":
-            grained_image = apply_gaussian_grain_cuda(image, scaled_strength, seed, 0.5)
-        elif grain == "fft":
-            grained_image = apply_fft_grain(image, scaled_strength, seed, 5)
-        elif grain == "fft_cuda":
-            grained_image = apply_fft_grain_cuda(image, scaled_strength, seed, 5)
-        elif grain == "mixed":
-            grained_image = apply_mixed_grain(image, scaled_strength, seed, 2.5)
-        elif grain == "mixed_cuda":
-            grained_image = apply_mixed_grain_cuda(image, scaled_strength, seed, 2.5)
-            
+
+        if grain.endswith("_cuda"):
+            grain, device = grain[:-len("_cuda")], "cuda"
+
+        bank_settings = (bank_plates, bank_dir.strip()) if texture_bank else None
+        grained_image = apply_grain(image, scaled_strength, seed, grain, device, filter_method, DTYPES[output_dtype], bank_settings,
+                                    stream_chunk_size, stream_workers)
         return (grained_image,)
 
 
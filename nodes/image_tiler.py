@@ -2,178 +2,342 @@ import sys
 import os
 import torch
 import math
+import functools
+import bisect
+import tempfile
+import atexit
+from ComfyUI_GOAT_Nodes.nodes.devices import DTYPES, get_device # type: ignore
 
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "comfy"))
 
 
-def radial_order_tiling(tiles, image_width, image_height, tile_width, tile_height):
+# The orderings work on the tile grid: tile_x and tile_y hold the pixel position of every tile in row-major grid
+# order, and each ordering returns the grid indices in processing order. The cost only depends on the tile count.
+
+
+def radial_order_tiling(tile_x, tile_y, image_width, image_height, tile_width, tile_height):
     # Get the center of the image
     center_x = image_width // 2
     center_y = image_height // 2
-    
-    # Function to calculate the Euclidean distance from the tile center to the image center
-    def tile_distance_from_center(tile):
-        tile_center_x = tile[0] + tile_width // 2
-        tile_center_y = tile[1] + tile_height // 2
-        return math.sqrt((tile_center_x - center_x) ** 2 + (tile_center_y - center_y) ** 2)
-    
-    # Sort the tiles by radial distance (Euclidean distance) from the image center
-    tiles = sorted(tiles, key=tile_distance_from_center)
-    
-    # Reverse the order so that the center is processed last
-    tiles = tiles[::-1]
-    
-    return tiles
+
+    # Squared Euclidean distance from the tile center to the image center, which sorts the same as the distance
+    distance = (tile_x + tile_width // 2 - center_x) ** 2 + (tile_y + tile_height // 2 - center_y) ** 2
+
+    # Sort the tiles by radial distance and reverse the order so that the center is processed last
+    return torch.argsort(distance, stable=True).flip(0)
 
 
-def checkerboard_order_tiling(tiles):
+def checkerboard_order_tiling(tile_x, tile_y):
     # Separate tiles into black and white groups for odd and even tiles
-    white_tiles = tiles[1::2]
-    black_tiles = tiles[0::2]
+    tile_count = tile_x.shape[0]
+    return torch.cat([torch.arange(1, tile_count, 2), torch.arange(0, tile_count, 2)])
 
-    
-    return white_tiles + black_tiles
 
+def spiral_order_tiling(tile_x, tile_y):
+    # Walks the bounding box of the tiles inwards one pixel ring at a time (top row, right column, bottom row,
+    # left column), expressed as a sort key: the ring a tile is on, the side it is reached from, and how far along
+    min_x, max_x = tile_x.min(), tile_x.max()
+    min_y, max_y = tile_y.min(), tile_y.max()
 
-def spiral_order_tiling(tiles):
-    # Create a set to hold tile coordinates for easy lookup
-    tile_set = set(tiles)
-    
-    # Initialize the spiral order list
-    spiral_tiles = []
-    
-    # Determine the bounds of the grid based on tile coordinates
-    min_x = min(tile[0] for tile in tiles)
-    max_x = max(tile[0] for tile in tiles)
-    min_y = min(tile[1] for tile in tiles)
-    max_y = max(tile[1] for tile in tiles)
-
-    left, right = min_x, max_x
-    top, bottom = min_y, max_y
-
-    while left <= right and top <= bottom:
-        # Traverse from left to right along the top row
-        for i in range(left, right + 1):
-            tile = (i, top)
-            if tile in tile_set:
-                spiral_tiles.append(tile)
-        top += 1
-
-        # Traverse from top to bottom along the right column
-        for i in range(top, bottom + 1):
-            tile = (right, i)
-            if tile in tile_set:
-                spiral_tiles.append(tile)
-        right -= 1
-
-        # Traverse from right to left along the bottom row, if applicable
-        if top <= bottom:
-            for i in range(right, left - 1, -1):
-                tile = (i, bottom)
-                if tile in tile_set:
-                    spiral_tiles.append(tile)
-            bottom -= 1
-
-        # Traverse from bottom to top along the left column, if applicable
-        if left <= right:
-            for i in range(bottom, top - 1, -1):
-                tile = (left, i)
-                if tile in tile_set:
-                    spiral_tiles.append(tile)
-            left += 1
-
-    return spiral_tiles
-
-
-def row_order_tiling(tiles):
+    distances = torch.stack([tile_y - min_y, max_x - tile_x, max_y - tile_y, tile_x - min_x])
+    ring = distances.min(dim=0).values
+    # The first side touching the ring wins, in the order the walk visits them
+    side = torch.argmax((distances == ring).int(), dim=0)
+    progress = torch.stack([tile_x - min_x, tile_y - min_y, max_x - tile_x, max_y - tile_y]).gather(0, side[None])[0]
+
+    span = int(max(max_x - min_x, max_y - min_y)) + 1
+    return torch.argsort((ring * 4 + side) * span + progress)
+
+
+def row_order_tiling(tile_x, tile_y):
     # Sort tiles by their y-coordinate, then x-coordinate
-    return sorted(tiles, key=lambda tile: (tile[1], tile[0]))
+    return torch.argsort(tile_y * (int(tile_x.max()) + 1) + tile_x)
 
 
-def column_order_tiling(tiles):
+def column_order_tiling(tile_x, tile_y):
     # Sort tiles by their x-coordinate, then y-coordinate
-    return sorted(tiles, key=lambda tile: (tile[0], tile[1]))
+    return torch.argsort(tile_x * (int(tile_y.max()) + 1) + tile_y)
 
 
-def diagonal_order_tiling(tiles):
+def diagonal_order_tiling(tile_x, tile_y):
     # Sort tiles by the sum of their x and y coordinates
-    return sorted(tiles, key=lambda tile: (tile[0] + tile[1]))
+    return torch.argsort(tile_x + tile_y, stable=True)
 
 
-def generate_tiles(
-    image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset=0, col_offset=0, tiling_mode="radial"
-):
-    tiles = []
+def get_tile_positions(image_length, tile_length, overlap, offset):
+    # Closed form of the tile walk along one axis: regular steps from 0, then one tile flush with the far border
+    last_position = max(image_length - tile_length, 0)
+    step = tile_length - overlap
+    count = max(math.ceil((image_length - tile_length) / step), 0) + 1
+
+    positions = []
+    for index in range(count):
+        position = last_position if index == count - 1 else index * step
+        # Shift each row/column by its index times the offset and keep it inside the image
+        positions.append(min(max(position + index * offset, 0), last_position))
+
+    # Offsets can push several tiles against the border, keep every position only once
+    return list(dict.fromkeys(positions))
 
-    y = 0
-    row_count = 0  # To track which row we're on
-    while y < image_height:
-        if y == 0:
-            next_y = y + tile_height - col_overlap
-        else:
-            next_y = y + tile_height - col_overlap
-
-        if y + tile_height >= image_height:
-            y = max(image_height - tile_height, 0)
-            next_y = image_height
-
-        x = 0
-        col_count = 0  # To track which column we're on
-        while x < image_width:
-            if x == 0:
-                next_x = x + tile_width - row_overlap
-            else:
-                next_x = x + tile_width - row_overlap
-
-            if x + tile_width >= image_width:
-                x = max(image_width - tile_width, 0)
-                next_x = image_width
-
-            # Apply row/col offset: Shift each row/column by the specified amount
-            x_offset = col_count * row_offset  # Offset for each column
-            y_offset = row_count * col_offset  # Offset for each row
-
-            tile_x = x + x_offset
-            tile_y = y + y_offset
-
-            # Ensure tiles stay within the image bounds
-            if tile_x + tile_width > image_width:
-                tile_x = max(image_width - tile_width, 0)
-            if tile_y + tile_height > image_height:
-                tile_y = max(image_height - tile_height, 0)
-
-            # Append tile only if it's within the image
-            if tile_x < image_width and tile_y < image_height:
-                tiles.append((tile_x, tile_y))
-
-            if next_x > image_width:
-                break
-            x = next_x
-            col_count += 1  # Increment column count after placing tile
-
-        if next_y > image_height:
-            break
-        y = next_y
-        row_count += 1  # Increment row count after processing each row
+
+def order_tiles(xs, ys, image_width, image_height, tile_width, tile_height, tiling_mode):
+    # Pixel positions of every grid cell in row-major order
+    tile_x = xs.repeat(ys.shape[0])
+    tile_y = ys.repeat_interleave(xs.shape[0])
 
     # Choose the tile ordering based on the tiling mode
     if tiling_mode == "radial":
-        return radial_order_tiling(tiles, image_width, image_height, tile_width, tile_height)
+        return radial_order_tiling(tile_x, tile_y, image_width, image_height, tile_width, tile_height)
     elif tiling_mode == "checkerboard":
-        return checkerboard_order_tiling(tiles)
+        return checkerboard_order_tiling(tile_x, tile_y)
     elif tiling_mode == "spiral":
-        return spiral_order_tiling(tiles)
+        return spiral_order_tiling(tile_x, tile_y)
     elif tiling_mode == "row":
-        return row_order_tiling(tiles)
+        return row_order_tiling(tile_x, tile_y)
     elif tiling_mode == "column":
-        return column_order_tiling(tiles)
+        return column_order_tiling(tile_x, tile_y)
     elif tiling_mode == "diagonal":
-        return diagonal_order_tiling(tiles)
+        return diagonal_order_tiling(tile_x, tile_y)
     else:
         raise ValueError(f"Unknown tiling mode: {tiling_mode}")
 
 
+class Tile_Plan:
+    # Geometry of a tiling: the tiles always form a (possibly uneven) grid of column and row positions
+    def __init__(self, image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, tiling_mode, xs, ys, order):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.row_overlap = row_overlap
+        self.col_overlap = col_overlap
+        self.tiling_mode = tiling_mode
+
+        # Grid positions in pixels, and the row-major grid index of every tile in processing order
+        self.xs = xs
+        self.ys = ys
+        self.order = order
+        self.rows = order // xs.shape[0]
+        self.cols = order % xs.shape[0]
+
+        # Processing index of the tile at every grid cell, for constant time neighbor lookups
+        self.grid = torch.empty((ys.shape[0], xs.shape[0]), dtype=torch.long)
+        self.grid.view(-1)[order] = torch.arange(order.shape[0])
+
+        self.coordinates = tuple(zip(xs[self.cols].tolist(), ys[self.rows].tolist()))
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    @property
+    def grid_size(self):
+        return self.grid.shape[0], self.grid.shape[1]
+
+    def get_grid_position(self, index):
+        return int(self.rows[index]), int(self.cols[index])
+
+    def get_neighbors(self, index):
+        # Processing indices of the left, top, right and bottom neighbors, None at the border of the grid
+        row, col = self.get_grid_position(index)
+        grid_rows, grid_cols = self.grid_size
+        return (
+            int(self.grid[row, col - 1]) if col > 0 else None,
+            int(self.grid[row - 1, col]) if row > 0 else None,
+            int(self.grid[row, col + 1]) if col + 1 < grid_cols else None,
+            int(self.grid[row + 1, col]) if row + 1 < grid_rows else None,
+        )
+
+
+@functools.lru_cache(maxsize=64)
+def plan_tiles(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset=0, col_offset=0, tiling_mode="radial"):
+    xs = torch.tensor(get_tile_positions(image_width, tile_width, row_overlap, row_offset), dtype=torch.long)
+    ys = torch.tensor(get_tile_positions(image_height, tile_height, col_overlap, col_offset), dtype=torch.long)
+    order = order_tiles(xs, ys, image_width, image_height, tile_width, tile_height, tiling_mode)
+    return Tile_Plan(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, tiling_mode, xs, ys, order)
+
+
+def get_axis_candidates(image_length, min_overlap, alignment):
+    # Every aligned tile length along one axis, with the overlap that spreads its minimal tile count most evenly
+    candidates = []
+    for tile_length in range(alignment, image_length + 1, alignment):
+        if tile_length == image_length:
+            candidates.append((1, 0, tile_length, max(1, min(min_overlap, tile_length - 2))))
+            continue
+        if tile_length - min_overlap < 2:
+            continue
+
+        count = math.ceil((image_length - tile_length) / (tile_length - min_overlap)) + 1
+        overlap = min((count * tile_length - image_length) // (count - 1), tile_length - 2)
+
+        positions = get_tile_positions(image_length, tile_length, overlap, 0)
+        overlaps = [tile_length - (end - start) for start, end in zip(positions, positions[1:])]
+        candidates.append((len(positions), max(overlaps) - min(overlaps), tile_length, overlap))
+
+    if not candidates:
+        # The axis is shorter than the alignment, so it can only be covered by one unaligned tile
+        candidates.append((1, 0, image_length, max(1, min(min_overlap, image_length - 2))))
+    return candidates
+
+
+@functools.lru_cache(maxsize=64)
+def auto_plan_tiles(image_width, image_height, max_tile_pixels, min_overlap, alignment):
+    # Picks the tile size and overlaps that cover the image with the fewest tiles under the pixel budget,
+    # preferring the most even overlap and then the fewest processed pixels
+    width_candidates = get_axis_candidates(image_width, min_overlap, alignment)
+    height_candidates = sorted(get_axis_candidates(image_height, min_overlap, alignment), key=lambda candidate: candidate[2])
+
+    # Best height candidate among all tile heights up to each candidate's height
+    best_heights = []
+    for candidate in height_candidates:
+        best = best_heights[-1] if best_heights else None
+        best_heights.append(candidate if best is None or candidate[:2] < best[:2] else best)
+    tile_heights = [candidate[2] for candidate in height_candidates]
+
+    best_plan = None
+    for columns, column_spread, tile_width, row_overlap in width_candidates:
+        height_index = bisect.bisect_right(tile_heights, max_tile_pixels // tile_width) - 1
+        if height_index < 0:
+            continue
+
+        rows, row_spread, tile_height, col_overlap = best_heights[height_index]
+        score = (columns * rows, column_spread + row_spread, columns * rows * tile_width * tile_height)
+        if best_plan is None or score < best_plan[0]:
+            best_plan = (score, tile_width, tile_height, row_overlap, col_overlap)
+
+    if best_plan is None:
+        raise ValueError(f"max_tile_pixels: {max_tile_pixels} is too small for tiles aligned to {alignment} pixels")
+    return best_plan[1:]
+
+
+def generate_tiles(
+    image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset=0, col_offset=0, tiling_mode="radial"
+):
+    plan = plan_tiles(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset, tiling_mode)
+    return list(plan.coordinates)
+
+
+def extract_tiles(image, tile_coordinates, tile_width, tile_height):
+    # Gathered with a single copy per tile, a view of the image would let in-place ops downstream change the source image
+    # and apply twice where tiles overlap
+    # Tiles are laid out image by image, so tile t of image n ends up at index n * tile_count + t
+    batch_size, tile_count, channels = image.shape[0], len(tile_coordinates), image.shape[3]
+    tiles = torch.empty((batch_size, tile_count, tile_height, tile_width, channels), dtype=image.dtype, device=image.device)
+    for index, (x, y) in enumerate(tile_coordinates):
+        tiles[:, index].copy_(image[:, y:y + tile_height, x:x + tile_width, :])
+    return tiles.flatten(0, 1)
+
+
+@functools.lru_cache(maxsize=32)
+def get_blend_ramp(blend_mode, blend_range):
+    # Evaluate the blend function once for the whole blend range as a single tensor expression
+    weight_func = Image_Untiler.get_weight_function(blend_mode)
+    t = torch.arange(blend_range, dtype=torch.float64) / max(blend_range, 1)
+    return weight_func(t)
+
+
+def get_edge_profile(length, ramp, blend_start, blend_end):
+    # 1D weights along one tile axis, ramping in at the start and out at the end where neighbors overlap
+    profile = torch.ones(length, dtype=torch.float64)
+    ramp_length = min(ramp.shape[0], length)
+    if blend_start:
+        profile[:ramp_length] *= ramp[:ramp_length]
+    if blend_end:
+        profile[length - ramp_length:] *= ramp[:ramp_length].flip(0)
+    return profile
+
+
+def get_blend_mask(tile_height, tile_width, edges, ramp, dtype, device=None):
+    # The blend weights are separable, so the full mask is the outer product of the row and column profiles
+    left, top, right, bottom = edges
+    row_profile = get_edge_profile(tile_height, ramp, top, bottom).to(device)
+    col_profile = get_edge_profile(tile_width, ramp, left, right).to(device)
+    return torch.outer(row_profile, col_profile).to(dtype).unsqueeze(-1)
+
+
+def allocate_mapped_buffer(shape, dtype, temp_dir=None):
+    # Zero filled tensor backed by a memory-mapped temporary file, so its size is bound by disk space instead of RAM
+    size = math.prod(shape)
+    with tempfile.NamedTemporaryFile(dir=temp_dir or None, prefix="goat_", suffix=".bin", delete=False) as file:
+        # Extending the empty file leaves it sparse, which reads back as zeros
+        file.truncate(size * torch.empty((), dtype=dtype).element_size())
+        path = file.name
+
+    buffer = torch.from_file(path, shared=True, size=size, dtype=dtype)
+
+    # The mapping stays valid after unlinking the file, systems that refuse to unlink mapped files clean up on exit
+    try:
+        os.remove(path)
+    except OSError:
+        atexit.register(lambda: os.path.exists(path) and os.remove(path))
+
+    return buffer.view(shape)
+
+
+class Tile_Accumulator:
+    # Blends tiles into the output as they arrive, so callers can stream tiles in chunks instead of stacking them all
+    BAND_HEIGHT = 256
+
+    def __init__(self, height, width, channels, dtype, blend_mode="sine", blend_range=128, batch_size=1, device=None,
+                 storage="memory", temp_dir=None):
+        self.height = height
+        self.width = width
+        self.dtype = dtype
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.storage = storage
+        self.temp_dir = temp_dir
+        self.ramp = get_blend_ramp(blend_mode, blend_range)
+        self.mask_cache = {}
+
+        self.output = self.allocate((batch_size, height, width, channels), dtype)
+        # The weights are identical for every channel and image, so a single plane is enough
+        self.weight_sum = self.allocate((1, height, width, 1), dtype)
+
+    def allocate(self, shape, dtype):
+        if self.storage == "disk":
+            return allocate_mapped_buffer(shape, dtype, self.temp_dir)
+        return torch.zeros(shape, dtype=dtype, device=self.device)
+
+    def get_mask(self, tile_height, tile_width, x, y):
+        edges = (x > 0, y > 0, x + tile_width < self.width, y + tile_height < self.height)
+        key = (tile_height, tile_width, edges)
+        weight_matrix = self.mask_cache.get(key)
+        if weight_matrix is None:
+            weight_matrix = get_blend_mask(tile_height, tile_width, edges, self.ramp, self.dtype, self.device)
+            self.mask_cache[key] = weight_matrix
+        return weight_matrix
+
+    def add(self, tile, x, y):
+        tile_height, tile_width = tile.shape[-3], tile.shape[-2]
+        weight_matrix = self.get_mask(tile_height, tile_width, x, y)
+
+        self.output[:, y:y + tile_height, x:x + tile_width, :].addcmul_(tile, weight_matrix)
+        self.weight_sum[:, y:y + tile_height, x:x + tile_width, :] += weight_matrix
+
+    def add_chunk(self, tiles, tile_coordinates):
+        # tiles are shaped (batch, tile, height, width, channels), each tile is blended into every image at once
+        # Only one chunk at a time is moved to the accumulation device and precision
+        tiles = tiles.to(self.device, self.dtype)
+        for index, (x, y) in enumerate(tile_coordinates):
+            self.add(tiles[:, index], x, y)
+
+    def finalize(self, dtype=None):
+        output, weight_sum = self.output, self.weight_sum
+        self.output = self.weight_sum = None
+        result = output if dtype is None or dtype == output.dtype else self.allocate(output.shape, dtype)
+
+        # Normalize in place one band at a time, so no full size temporaries are created
+        # Pixels without any weight are left untouched
+        for start in range(0, self.height, self.BAND_HEIGHT):
+            band_weights = weight_sum[:, start:start + self.BAND_HEIGHT]
+            band_weights.masked_fill_(band_weights == 0, 1)
+            band = output[:, start:start + self.BAND_HEIGHT].div_(band_weights)
+            if result is not output:
+                result[:, start:start + self.BAND_HEIGHT].copy_(band)
+
+        return result
+
+
 class Image_Tiler:
     @classmethod
     def INPUT_TYPES(self):
@@ -187,52 +351,66 @@ class Image_Tiler:
                 "row_offset": ("INT", {"default": 0, "min": -8192, "max": 8192}),  # New row offset
                 "col_offset": ("INT", {"default": 0, "min": -8192, "max": 8192}),  # New column offset
                 "tiling_mode": (["radial", "checkerboard", "spiral", "row", "column", "diagonal"], {"default": "radial"}),
+                "planning_mode": (["manual", "auto"], {"default": "manual"}),
+                "max_tile_pixels": ("INT", {"default": 1048576, "min": 64, "max": 67108864, "step": 64}),
+                "min_overlap": ("INT", {"default": 128, "min": 1, "max": 8192}),
+                "alignment": ("INT", {"default": 64, "min": 1, "max": 1024}),
             }
         }
 
-    RETURN_TYPES = ("IMAGE", "TILE_DATA", "INT",)
-    RETURN_NAMES = ("IMAGES", "TILE_DATA", "TILE_COUNT",)
+    RETURN_TYPES = ("IMAGE", "TILE_DATA", "INT", "STRING",)
+    RETURN_NAMES = ("IMAGES", "TILE_DATA", "TILE_COUNT", "TILE_PLAN",)
     FUNCTION = "exec"
     CATEGORY = '🐐 GOAT Nodes/Image'
     DESCRIPTION = '''
-    Splits an image into tiles.\n
+    Splits an image into tiles. Batches are tiled in one pass, with the tiles of each image following each other.\n
     ‣ tile_width | Sets the width of the tiles to the specified value.\n
     ‣ tile_height | Sets the height of the tiles to the specified value.\n
     ‣ row_overlap | Specifies the amount of overlap of information between horizontal adjacent tiles.\n
     ‣ col_overlap | Specifies the amount of overlap of information between vertical adjacent tiles.\n
     ‣ row_offset | Shifts each row by the specified amount (f.e. to remove inconvenient horizontal tile edges).\n
     ‣ col_offset | Shifts each column by the specified amount (f.e. to remove inconvenient vertical tile edges).\n
-    ‣ tiling_mode | Specifies the order in which the tiles are processed.
+    ‣ tiling_mode | Specifies the order in which the tiles are processed.\n
+    ‣ planning_mode | manual uses the tile sizes, overlaps and offsets above. auto picks the tile size and overlaps that cover the image with the fewest tiles and the most even overlap.\n
+    ‣ max_tile_pixels | (auto) Maximum amount of pixels per tile.\n
+    ‣ min_overlap | (auto) Minimum overlap between adjacent tiles.\n
+    ‣ alignment | (auto) Tile sizes are multiples of this value (f.e. 8 or 64 for diffusion models).
     '''
 
 
-    def exec(self, image, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset, tiling_mode):
+    def exec(self, image, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset, tiling_mode,
+             planning_mode="manual", max_tile_pixels=1048576, min_overlap=128, alignment=64):
         image_height = image.shape[1]
         image_width = image.shape[2]
 
-        self.debugger(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset)
+        if planning_mode == "auto":
+            tile_width, tile_height, row_overlap, col_overlap = auto_plan_tiles(image_width, image_height, max_tile_pixels, min_overlap, alignment)
+            row_offset, col_offset = 0, 0
 
-        tile_coordinates = generate_tiles(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset, tiling_mode)
+        self.debugger(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset)
 
-        print("🐐 Image Tiler: Tile coordinates: {}".format(tile_coordinates))
+        tile_plan = plan_tiles(image_width, image_height, tile_width, tile_height, row_overlap, col_overlap, row_offset, col_offset, tiling_mode)
+        tile_coordinates = tile_plan.coordinates
 
-        image_tiles = []
-        image_count = 0
-        for tile_coordinate in tile_coordinates:
-            image_count += 1
-            image_tile = image[
-                :,
-                tile_coordinate[1] : tile_coordinate[1] + tile_height,
-                tile_coordinate[0] : tile_coordinate[0] + tile_width,
-                :,
-            ]
+        grid_rows, grid_cols = tile_plan.grid_size
+        plan_description = f"{grid_cols}x{grid_rows} tiles of {tile_width}x{tile_height} | Overlap: {row_overlap}x{col_overlap}"
 
-            image_tiles.append(image_tile)
+        print(f"🐐 Image Tiler: {plan_description}")
+        print("🐐 Image Tiler: Tile coordinates: {}".format(tile_coordinates))
 
-        tiles_tensor = torch.stack(image_tiles).squeeze(1)
-        tile_data = (image_height, image_width, tile_coordinates)
+        tiles_tensor = extract_tiles(image, tile_coordinates, tile_width, tile_height)
+        tile_data = {
+            "image_height": image_height,
+            "image_width": image_width,
+            "tile_height": tile_height,
+            "tile_width": tile_width,
+            "tile_coordinates": tile_coordinates,
+            "tile_plan": tile_plan,
+            "batch_size": image.shape[0],
+            "channels": image.shape[3],
+        }
 
-        return (tiles_tensor, tile_data, image_count)
+        return (tiles_tensor, tile_data, len(tile_coordinates), plan_description)
     
     
     @staticmethod
@@ -260,54 +438,65 @@ class Image_Untiler:
                 "tile_data": ("TILE_DATA",),
                 "blend_mode": (["linear", "sine", "cubic", "quadratic", "hermite", "sine_quadratic_mix", "quadratic_sine_mix"], {"default": "sine"}),
                 "blend_range": ("INT", {"default": 128, "min": 0, "max": 8192}),
+                "device": (["auto", "cuda", "cpu"], {"default": "auto"}),
+                "accumulate_dtype": (["auto", "float32", "float64", "float16", "bfloat16"], {"default": "auto"}),
+                "storage": (["memory", "disk"], {"default": "memory"}),
+                "temp_dir": ("STRING", {"default": ""}),
             }
         }
     
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "exec"
     CATEGORY = '🐐 GOAT Nodes/Image'
+    CHUNK_SIZE = 16
     DESCRIPTION = '''
     Merges tiles into an image.\n
     ‣ blend_range | Specifies the size of the blending region around the edges of each tile.\n
-    ‣ blend_mode | Specifies the blending function to use when merging the tiles.
+    ‣ blend_mode | Specifies the blending function to use when merging the tiles.\n
+    ‣ device | Device the tiles are blended and returned on. auto keeps the device the tiles already live on.\n
+    ‣ accumulate_dtype | Precision of the blending buffers. auto uses the precision of the tiles.\n
+    ‣ storage | memory keeps the blending buffers in RAM. disk keeps them in a memory-mapped temporary file (CPU only), so very large images are bound by disk space instead of RAM.\n
+    ‣ temp_dir | (disk) Directory for the memory-mapped file. Empty uses the system temp directory.
     '''
     
-    def exec(self, images, blend_range, tile_data, blend_mode="sine"):
-        final_height, final_width, tile_coordinates = tile_data
-        tile_height, tile_width = images.shape[1], images.shape[2]
-
-        original_shape = (1, final_height, final_width, 3)
-        output = torch.zeros(original_shape, dtype=images.dtype)
-        weight_sum = torch.zeros(original_shape, dtype=images.dtype)
+    def exec(self, images, blend_range, tile_data, blend_mode="sine", device="auto", accumulate_dtype="auto", storage="memory", temp_dir=""):
+        final_height, final_width = tile_data["image_height"], tile_data["image_width"]
+        tile_coordinates = tile_data["tile_coordinates"]
+        batch_size, tile_count = tile_data["batch_size"], len(tile_coordinates)
+
+        if images.shape[0] != batch_size * tile_count:
+            raise ValueError(f"images: {images.shape[0]} does not match the {batch_size} x {tile_count} tiles recorded in tile_data")
+
+        # Restore the (batch, tile) layout written by the tiler
+        tiles = images.unflatten(0, (batch_size, tile_count))
+
+        blend_device = get_device(device, images.device, "Image Untiler")
+        blend_dtype = DTYPES.get(accumulate_dtype, images.dtype)
+
+        if storage == "disk" and blend_device.type != "cpu":
+            print("🐐 Image Untiler: Disk storage blends on the CPU.")
+            blend_device = torch.device("cpu")
+
+        accumulator = Tile_Accumulator(final_height, final_width, images.shape[3], blend_dtype, blend_mode, blend_range, batch_size, blend_device,
+                                       storage, temp_dir)
+
+        if storage == "disk":
+            # Blend the tiles row by row, so the memory-mapped buffers are written in horizontal bands
+            order = sorted(range(tile_count), key=lambda index: (tile_coordinates[index][1], tile_coordinates[index][0]))
+            chunks = (
+                (tiles[:, order[start:start + self.CHUNK_SIZE]], [tile_coordinates[index] for index in order[start:start + self.CHUNK_SIZE]])
+                for start in range(0, tile_count, self.CHUNK_SIZE)
+            )
+        else:
+            chunks = (
+                (tiles[:, start:start + self.CHUNK_SIZE], tile_coordinates[start:start + self.CHUNK_SIZE])
+                for start in range(0, tile_count, self.CHUNK_SIZE)
+            )
 
-        weight_func = self.get_weight_function(blend_mode)
+        for chunk, chunk_coordinates in chunks:
+            accumulator.add_chunk(chunk, chunk_coordinates)
 
-        for index, (x, y) in enumerate(tile_coordinates):
-            image_tile = images[index]
-            
-            # Calculate blending weights
-            weight_matrix = torch.ones((tile_height, tile_width, 3), dtype=images.dtype)
-            
-            for i in range(blend_range):
-                weight = weight_func(float(i) / blend_range)
-                if x > 0:
-                    weight_matrix[:, i, :] *= weight  # Left edge
-                if y > 0:
-                    weight_matrix[i, :, :] *= weight  # Top edge
-                if x + tile_width < final_width:
-                    weight_matrix[:, -(i + 1), :] *= weight  # Right edge
-                if y + tile_height < final_height:
-                    weight_matrix[-(i + 1), :, :] *= weight  # Bottom edge
-
-            # Apply the weight matrix to the tile
-            weighted_tile = image_tile * weight_matrix
-
-            # Add the weighted tile to the output
-            output[:, y:y + tile_height, x:x + tile_width, :] += weighted_tile
-            weight_sum[:, y:y + tile_height, x:x + tile_width, :] += weight_matrix
-
-        # Normalize the output by dividing by the sum of weights
-        output = torch.where(weight_sum > 0, output / weight_sum, output)
+        output = accumulator.finalize(images.dtype)
 
         return [output]
     
@@ -317,7 +506,7 @@ class Image_Untiler:
         if blend_mode == "linear":
             return lambda t: t
         elif blend_mode == "sine":
-            return lambda t: 0.5 - 0.5 * math.cos(math.pi * t)
+            return lambda t: 0.5 - 0.5 * torch.cos(math.pi * t)
         elif blend_mode == "cubic":
             return lambda t: -2 * t**3 + 3 * t**2
         elif blend_mode == "quadratic":
@@ -325,12 +514,12 @@ class Image_Untiler:
         elif blend_mode == "hermite":
             return lambda t: 3 * t**2 - 2 * t**3
         elif blend_mode == "sine_quadratic_mix":
-            sine_func = lambda t: 0.5 - 0.5 * math.cos(math.pi * t)
+            sine_func = lambda t: 0.5 - 0.5 * torch.cos(math.pi * t)
             quadratic_func = lambda t: t * (2 - t)
             # More weight to Quadratic near the center (t ≈ 0.5), more to sine near the edges (t ≈ 0 or t ≈ 1)
             return lambda t: (1 - (2 * t - 1)**2) * quadratic_func(t) + (2 * t - 1)**2 * sine_func(t)
         elif blend_mode == "quadratic_sine_mix":
-            sine_func = lambda t: 0.5 - 0.5 * math.cos(math.pi * t)
+            sine_func = lambda t: 0.5 - 0.5 * torch.cos(math.pi * t)
             quadratic_func = lambda t: t * (2 - t)
             # More weight to Sine near the center (t ≈ 0.5), more to Quadratic near the edges (t ≈ 0 or t ≈ 1)
             return lambda t: (1 - (2 * t - 1)**2) * sine_func(t) + (2 * t - 1)**2 * quadratic_func(t)
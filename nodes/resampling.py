@@ -0,0 +1,117 @@
+import torch  # type: ignore
+import math
+import functools
+
+
+def get_lanczos_weight(x):
+    # Lanczos filter with a support of 3, as used by PIL
+    return torch.where(x.abs() < 3, torch.sinc(x) * torch.sinc(x / 3), torch.zeros_like(x))
+
+
+def get_resample_weights(in_length, out_length, method):
+    # Sparse resampling matrix along one axis as (indices, weights) of shape (out_length, taps), matching
+    # torch.nn.functional.interpolate for nearest-exact, area, linear and cubic and PIL for lanczos, borders included
+    scale = in_length / out_length
+    position = torch.arange(out_length, dtype=torch.float64)
+    # interpolate maps output rows onto the input with a single precision scale and rounds the position to single precision,
+    # following it keeps the weights of long axes from drifting by up to 1e-4
+    scale_single = torch.tensor(scale, dtype=torch.float32)
+    if method == "nearest-exact":
+        source = ((position.float() + 0.5) * scale_single).floor().long()
+        indices = source.clamp(max=in_length - 1).unsqueeze(1)
+        weights = torch.ones(out_length, 1, dtype=torch.float64)
+    elif method == "area":
+        # Adaptive average pooling windows
+        start = position.long() * in_length // out_length
+        end = ((position.long() + 1) * in_length + out_length - 1) // out_length
+        taps = int((end - start).max())
+        indices = start.unsqueeze(1) + torch.arange(taps)
+        weights = torch.where(indices < end.unsqueeze(1), 1 / (end - start).unsqueeze(1).double(), torch.zeros((), dtype=torch.float64))
+    elif method == "bilinear":
+        source = (scale_single.double() * (position + 0.5) - 0.5).float().clamp(min=0)
+        start = source.floor()
+        fraction = (source - start).double().unsqueeze(1)
+        indices = start.long().unsqueeze(1) + torch.arange(2)
+        weights = torch.cat((1 - fraction, fraction), dim=1)
+    elif method == "bicubic":
+        a = -0.75
+        source = (scale_single.double() * (position + 0.5) - 0.5).float()
+        start = source.floor()
+        t = (source - start).double().unsqueeze(1)
+        distance = torch.cat((t + 1, t, 1 - t, 2 - t), dim=1)
+        near = ((a + 2) * distance - (a + 3)) * distance * distance + 1
+        far = ((a * distance - 5 * a) * distance + 8 * a) * distance - 4 * a
+        weights = torch.where(distance <= 1, near, far)
+        indices = start.long().unsqueeze(1) + torch.arange(-1, 3)
+    elif method == "lanczos":
+        filter_scale = max(scale, 1.0)
+        support = 3 * filter_scale
+        center = (position + 0.5) * scale
+        start = (center - support + 0.5).floor().clamp(min=0)
+        taps = math.ceil(2 * support) + 2
+        indices = start.long().unsqueeze(1) + torch.arange(taps)
+        weights = get_lanczos_weight((indices - center.unsqueeze(1) + 0.5) / filter_scale)
+        end = (center + support + 0.5).floor().clamp(max=in_length).unsqueeze(1)
+        weights = torch.where(indices < end, weights, torch.zeros_like(weights))
+        weights /= weights.sum(dim=1, keepdim=True)
+    else:
+        raise ValueError(f"No fast resampling weights for {method}.")
+    return indices.clamp(0, in_length - 1), weights
+
+
+@functools.lru_cache(maxsize=32)
+def get_mixed_initial_band(length, method):
+    # The 2x upscale followed by the downscale back is linear and separable, so each axis collapses into a
+    # banded (length, taps) matrix applied at native resolution; band[:, k] weighs pixel i + k - radius
+    up_indices, up_weights = get_resample_weights(length, length * 2, method)
+    down_indices, down_weights = get_resample_weights(length * 2, length, method)
+    indices = up_indices[down_indices]
+    weights = up_weights[down_indices] * down_weights.unsqueeze(2)
+    offsets = indices.flatten(1) - torch.arange(length).unsqueeze(1)
+    radius = int(offsets.abs().max())
+    band = torch.zeros(length, 2 * radius + 1, dtype=torch.float64)
+    band.scatter_add_(1, offsets + radius, weights.flatten(1))
+    return band
+
+
+def apply_band(image, band, dim):
+    # Pixels outside the image always get a zero weight, so clamped indices only keep the gather in bounds
+    length = image.shape[dim]
+    radius = (band.shape[1] - 1) // 2
+    padded = image.index_select(dim, torch.arange(-radius, length + radius, device=image.device).clamp(0, length - 1))
+    band = band.to(image.device, image.dtype)
+    shape = [1] * image.ndim
+    shape[dim] = length
+
+    result = torch.zeros_like(image)
+    for k in range(band.shape[1]):
+        if band[:, k].any():
+            result.addcmul_(padded.narrow(dim, k, length), band[:, k].view(shape))
+    return result
+
+
+def get_mixed_initial(image, method):
+    # Half the (N, H, W, C) image and half its 2x upscale scaled back down, computed at native resolution
+    if method in ("nearest-exact", "area"):
+        # Both resample the exact 2x grid back onto itself, so the mix is the image itself
+        return image
+    resampled = apply_band(image, get_mixed_initial_band(image.shape[1], method) * 0.5, 1)
+    resampled = apply_band(resampled, get_mixed_initial_band(image.shape[2], method), 2)
+    return resampled.add_(image, alpha=0.5)
+
+
+def resample_rows(image, in_length, out_length, start, stop, offset, method):
+    # Rows start to stop of resizing in_length rows to out_length along dim 2 of a (N, C, H, W) tensor that only holds the
+    # rows from offset on, so a band of an image lands on exactly the rows and sampling grid of resizing the whole image
+    # Rows the band does not hold are clamped to its border, which only affects rows that are blended with the next band
+    if in_length == out_length:
+        return image.index_select(2, (torch.arange(start, stop) - offset).clamp(0, image.shape[2] - 1).to(image.device))
+
+    indices, weights = get_resample_weights(in_length, out_length, method)
+    indices = (indices[start:stop] - offset).clamp(0, image.shape[2] - 1).to(image.device)
+    weights = weights[start:stop].to(image.device, image.dtype)
+
+    result = torch.zeros(image.shape[:2] + (stop - start, image.shape[3]), dtype=image.dtype, device=image.device)
+    for k in range(indices.shape[1]):
+        result.addcmul_(image.index_select(2, indices[:, k]), weights[:, k].view(1, 1, -1, 1))
+    return result
@@ -0,0 +1,127 @@
+import torch  # type: ignore
+import os
+import hashlib
+import collections
+
+
+def hash_tensor(tensor):
+    # Content hash of the raw tensor bytes, including shape and dtype
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{tuple(tensor.shape)}|{tensor.dtype}".encode())
+    digest.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+    return digest.hexdigest()
+
+
+def get_cache_key(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+class Result_Cache:
+    # LRU cache of tensor tuples bounded by a byte budget, evicted entries optionally spill to a cache directory
+    def __init__(self, budget_bytes=2048 * 1024 ** 2, cache_dir="", prefix="goat_cache", name="GOAT Nodes"):
+        self.entries = collections.OrderedDict()
+        self.disk_entries = collections.OrderedDict()
+        self.budget_bytes = budget_bytes
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self.name = name
+        self.used_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def get_size(value):
+        return sum(item.nelement() * item.element_size() for item in value if isinstance(item, torch.Tensor))
+
+
+    def configure(self, budget_bytes, cache_dir=""):
+        self.budget_bytes = budget_bytes
+        if cache_dir != self.cache_dir:
+            self.clear_disk()
+            self.cache_dir = cache_dir
+        self.evict()
+
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{self.prefix}_{key}.pt")
+
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+        if key in self.disk_entries:
+            path = self.get_path(key)
+            self.disk_bytes -= self.disk_entries.pop(key)
+            try:
+                value = torch.load(path)
+                os.remove(path)
+            except (OSError, RuntimeError) as e:
+                print(f"🐐 {self.name}: Could not read cache file {path}: {e}")
+            else:
+                self.hits += 1
+                self.put(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+
+    def put(self, key, value):
+        size = self.get_size(value)
+        if size > self.budget_bytes:
+            return
+        # Copies, a slice would keep the storage of the whole batch alive (and spill all of it) while only its own size is counted
+        value = tuple(item.detach().to("cpu", copy=True) if isinstance(item, torch.Tensor) else item for item in value)
+        if key in self.entries:
+            self.used_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.used_bytes += size
+        self.evict()
+
+
+    def evict(self):
+        while self.used_bytes > self.budget_bytes and self.entries:
+            key, (value, size) = self.entries.popitem(last=False)
+            self.used_bytes -= size
+            if self.cache_dir:
+                self.spill(key, value, size)
+
+
+    def spill(self, key, value, size):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save(value, self.get_path(key))
+        except (OSError, RuntimeError) as e:
+            print(f"🐐 {self.name}: Could not write cache file: {e}")
+            return
+        self.disk_entries[key] = size
+        self.disk_bytes += size
+
+        # The cache directory gets the same budget as memory
+        while self.disk_bytes > self.budget_bytes and self.disk_entries:
+            old_key, old_size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= old_size
+            self.remove_file(old_key)
+
+
+    def remove_file(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+
+    def clear_disk(self):
+        for key in self.disk_entries:
+            self.remove_file(key)
+        self.disk_entries.clear()
+        self.disk_bytes = 0
+
+
+    def describe(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} entries, {self.used_bytes / 1024 ** 2:.1f} MB"
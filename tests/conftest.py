@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+
+# The package root imports every node and with them ComfyUI itself, so the tests register the package without running
+# its __init__ and import the node modules that only need torch directly
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+if "ComfyUI_GOAT_Nodes" not in sys.modules:
+    package = types.ModuleType("ComfyUI_GOAT_Nodes")
+    package.__path__ = [ROOT]
+    sys.modules["ComfyUI_GOAT_Nodes"] = package
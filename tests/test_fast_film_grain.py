@@ -0,0 +1,89 @@
+import pytest
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from ComfyUI_GOAT_Nodes.nodes.fast_film_grain import apply_grain
+from ComfyUI_GOAT_Nodes.nodes.result_cache import hash_tensor
+
+
+def get_peak_memory(image, *args, **kwargs):
+    # tracemalloc does not see the torch CPU allocator, the profiler records every allocation and free of it instead,
+    # including the temporaries inside single ops like irfft2
+    # The first run fills the filter caches, which are shared between runs and not part of the per image cost
+    apply_grain(image, *args, **kwargs)
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as profiler:
+        apply_grain(image, *args, **kwargs)
+
+    events = [event for event in profiler.profiler.kineto_results.events() if event.name() == "[memory]"]
+    live = peak = 0
+    for event in sorted(events, key=lambda event: event.start_ns()):
+        live += event.nbytes()
+        peak = max(peak, live)
+    return peak
+
+
+# Buffers the size of the whole batch: the output and the noise, for fft and mixed also the filtered noise
+# Buffers the size of one frame: the rfft2 half spectrum and the copy of it, work buffer and result irfft2 allocates, and the
+# filtered frame while it is copied into the batch
+GRAIN_BUFFERS = [("gaussian", 2, 0), ("fft", 3, 5), ("mixed", 3, 5)]
+
+# The half spectrum holds one extra column
+SLACK = 0.05
+
+
+@pytest.mark.parametrize("grain, batch_buffers, frame_buffers", GRAIN_BUFFERS)
+def test_peak_memory_per_megapixel(grain, batch_buffers, frame_buffers):
+    image = torch.rand(4, 512, 768, 3)
+    megapixels = image.shape[0] * image.shape[1] * image.shape[2] / 1e6
+    input_per_megapixel = image.nelement() * image.element_size() / megapixels
+
+    peak_per_megapixel = get_peak_memory(image, 0.1, 0, grain, "cpu") / megapixels
+    buffers = batch_buffers + frame_buffers / image.shape[0]
+    assert peak_per_megapixel <= (buffers + SLACK) * input_per_megapixel
+
+
+@pytest.mark.parametrize("grain, batch_buffers, frame_buffers", GRAIN_BUFFERS)
+def test_peak_memory_lower_precision_output(grain, batch_buffers, frame_buffers):
+    image = torch.rand(4, 512, 768, 3)
+    input_size = image.nelement() * image.element_size()
+
+    # A float16 output is half the size of the float32 input, the work buffers keep the input precision
+    peak = get_peak_memory(image, 0.1, 0, grain, "cpu", output_dtype=torch.float16)
+    buffers = batch_buffers - 0.5 + frame_buffers / image.shape[0]
+    assert peak <= (buffers + SLACK) * input_size
+
+
+@pytest.mark.parametrize("grain, batch_buffers, frame_buffers", GRAIN_BUFFERS)
+def test_peak_memory_streamed(grain, batch_buffers, frame_buffers):
+    image = torch.rand(8, 256, 384, 3)
+    input_size = image.nelement() * image.element_size()
+    chunk_size = 2
+
+    # Only the output is batch sized, the other buffers are bound by the chunk
+    buffers = 1 + ((batch_buffers - 1) * chunk_size + frame_buffers) / image.shape[0]
+    assert get_peak_memory(image, 0.1, 0, grain, "cpu", chunk_size=chunk_size) <= (buffers + SLACK) * input_size
+
+
+@pytest.mark.parametrize("grain", ["gaussian", "fft", "mixed"])
+def test_grain_independent_of_chunks(grain):
+    image = torch.rand(7, 64, 96, 3)
+    grained = apply_grain(image, 0.1, 1, grain, "cpu")
+
+    # Chunks of a single frame take a different rfft2 path than batches, so they are included on purpose
+    for chunk_size, workers in ((1, 1), (2, 1), (3, 2)):
+        assert torch.equal(apply_grain(image, 0.1, 1, grain, "cpu", chunk_size=chunk_size, workers=workers), grained)
+
+
+# Output of a single frame, pinned so changes to the filter or the noise cannot move the grain unnoticed
+# fft and mixed differ by up to 1 ulp from the versions before the half spectrum filter, gaussian is unchanged since then
+PINNED_GRAIN = [
+    ("gaussian", "28c468302923f134cf3355a5cb6cdeab"),
+    ("fft", "7fa137f5a6b8d5171dc03b89259983db"),
+    ("mixed", "e3063bf9b26a7bef243d83c697528369"),
+]
+
+
+@pytest.mark.parametrize("grain, digest", PINNED_GRAIN)
+def test_single_frame_grain_is_pinned(grain, digest):
+    image = torch.rand(1, 48, 64, 3, generator=torch.Generator().manual_seed(0))
+    assert hash_tensor(apply_grain(image, 0.3, 12345, grain, "cpu")) == digest
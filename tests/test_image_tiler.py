@@ -0,0 +1,13 @@
+import torch
+
+from ComfyUI_GOAT_Nodes.nodes.image_tiler import extract_tiles
+
+
+def test_tiles_do_not_alias_the_image():
+    # A single row of overlapping tiles at a constant step, which could be expressed as one strided view of the image
+    image = torch.ones(1, 128, 1024, 3)
+    tiles = extract_tiles(image, [(x, 0) for x in range(0, 1024 - 256 + 1, 128)], 256, 128)
+
+    tiles.mul_(0.5)
+    assert torch.equal(image, torch.ones_like(image))
+    assert torch.equal(tiles, torch.full_like(tiles, 0.5))
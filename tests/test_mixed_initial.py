@@ -0,0 +1,29 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from ComfyUI_GOAT_Nodes.nodes.resampling import get_mixed_initial
+
+
+@pytest.mark.parametrize("method", ["bilinear", "bicubic"])
+@pytest.mark.parametrize("height, width", [(64, 96), (37, 53)])
+def test_banded_mix_matches_round_trip(method, height, width):
+    image = torch.rand(2, height, width, 3)
+
+    samples = image.movedim(-1, 1)
+    upscaled = F.interpolate(samples, size=(height * 2, width * 2), mode=method, align_corners=False)
+    downscaled = F.interpolate(upscaled, size=(height, width), mode=method, align_corners=False)
+    expected = (samples * 0.5 + downscaled * 0.5).movedim(1, -1)
+
+    assert (get_mixed_initial(image, method) - expected).abs().max() <= 1e-6
+
+
+@pytest.mark.parametrize("method", ["nearest-exact", "area"])
+def test_exact_round_trips_return_the_image(method):
+    image = torch.rand(2, 37, 53, 3)
+    assert torch.equal(get_mixed_initial(image, method), image)
+
+    # The shortcut holds for the round trip through interpolate as well
+    samples = image.movedim(-1, 1)
+    upscaled = F.interpolate(samples, size=(74, 106), mode=method)
+    assert torch.equal(F.interpolate(upscaled, size=(37, 53), mode=method).movedim(1, -1), image)
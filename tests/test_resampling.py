@@ -0,0 +1,60 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from ComfyUI_GOAT_Nodes.nodes.resampling import resample_rows
+
+
+METHODS = [("nearest-exact", 0), ("area", 1e-6), ("bilinear", 1e-6), ("bicubic", 2e-6)]
+
+
+def resize_rows(image, height, method):
+    if method in ("bilinear", "bicubic"):
+        return F.interpolate(image, size=(height, image.shape[3]), mode=method, align_corners=False)
+    return F.interpolate(image, size=(height, image.shape[3]), mode=method)
+
+
+@pytest.mark.parametrize("method, tolerance", METHODS)
+@pytest.mark.parametrize("in_length, out_length", [(160, 848), (160, 592), (97, 13), (256, 339), (424, 424)])
+def test_bands_match_whole_image(method, tolerance, in_length, out_length):
+    image = torch.rand(1, 3, in_length, 24)
+    expected = resize_rows(image, out_length, method)
+
+    # Bands with a margin around the rows they produce, as the streamed upscale cuts them
+    bands = 4
+    for band in range(bands):
+        start, stop = band * out_length // bands, (band + 1) * out_length // bands
+        top = max(0, int(start * in_length / out_length) - 3)
+        bottom = min(in_length, int(stop * in_length / out_length) + 4)
+        rows = resample_rows(image[:, :, top:bottom], in_length, out_length, start, stop, top, method)
+        assert (rows - expected[:, :, start:stop]).abs().max() <= tolerance
+
+
+def test_streamed_matches_in_memory():
+    pytest.importorskip("comfy")
+    from ComfyUI_GOAT_Nodes.nodes.advanced_upscale_image_using_model import Advanced_Upscale_Image_Using_Model
+
+    class Upscale_Model:
+        # Stand-in for a 2x model that resizes bilinearly
+        scale = 2
+        model = torch.nn.Identity()
+
+        def to(self, device):
+            return self
+
+        def __call__(self, image):
+            return F.interpolate(image, scale_factor=self.scale, mode="bilinear")
+
+    # Smooth content, so the only differences left are the bilinear model at the band borders, which are blended
+    y, x = torch.meshgrid(torch.linspace(0, 1, 160), torch.linspace(0, 1, 200), indexing="ij")
+    image = torch.stack((0.5 + 0.4 * torch.sin(6 * x + 3 * y), 0.5 + 0.4 * torch.cos(5 * y), x * y), dim=-1)[None]
+
+    node = Advanced_Upscale_Image_Using_Model
+    for method in ("nearest-exact", "bilinear", "area", "bicubic"):
+        for upscale_by in (6.0, 5.3, 3.7):
+            for upscale_first in (True, False):
+                expected = node.process_stage2(Upscale_Model(), image, upscale_by, 1, method, upscale_first, True, (512, 16, 4))
+                streamed = node.process_stage2_streaming(Upscale_Model(), image, upscale_by, 1, method, upscale_first, True, (512, 16, 4),
+                                                         band_height=48)
+                assert streamed.shape == expected.shape
+                assert (streamed - expected).abs().max() <= 0.01 / 255
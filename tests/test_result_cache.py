@@ -0,0 +1,25 @@
+import os
+
+import torch
+
+from ComfyUI_GOAT_Nodes.nodes.result_cache import Result_Cache
+
+
+def test_entries_own_their_storage(tmp_path):
+    batch = torch.rand(8, 64, 64, 3)
+    frame_size = batch[0].nelement() * batch.element_size()
+    # Room for one frame in memory, so the second put spills the first
+    cache = Result_Cache(frame_size, str(tmp_path))
+
+    cache.put("first", (batch[0:1],))
+    stored = cache.entries["first"][0][0]
+    assert stored.untyped_storage().nbytes() == frame_size
+    assert torch.equal(stored, batch[0:1])
+
+    batch[0] = 0
+    assert not torch.equal(stored, batch[0:1])
+
+    cache.put("second", (batch[1:2],))
+    assert "first" in cache.disk_entries
+    # The spill file holds the frame and the pickle around it, not the whole batch
+    assert os.path.getsize(cache.get_path("first")) < 2 * frame_size